@@ -0,0 +1,78 @@
+"""So sánh tốc độ decode nến BingX: đường cũ bằng pandas và decode.py
+
+Chạy từ thư mục gốc của repo:
+
+    python benchmarks/bench_decode.py
+"""
+
+import json
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+from decode import decode_bingx_klines, orjson  # noqa: E402
+
+
+def make_bingx_body(n_candles=1000):
+    rng = np.random.default_rng(0)
+    close = 60000 + np.cumsum(rng.normal(0, 20, n_candles))
+    data = [
+        {
+            "open": f"{close[i] - 5:.2f}",
+            "close": f"{close[i]:.2f}",
+            "high": f"{close[i] + 10:.2f}",
+            "low": f"{close[i] - 10:.2f}",
+            "volume": f"{rng.random() * 100:.4f}",
+            "time": 1_700_000_000_000 + (n_candles - i) * 60_000,
+        }
+        for i in range(n_candles)
+    ]
+    return json.dumps({"code": 0, "msg": "", "data": data}).encode("utf-8")
+
+
+def decode_pandas(body):
+    """Đường decode cũ của connect_price_API_BINGX + check_price_crypto"""
+    data = json.loads(body)
+    df = pd.DataFrame(data["data"])
+    df_final = df.sort_index(ascending=False).reset_index(drop=True)
+    df_final.drop(["volume"], axis=1, inplace=True)
+    df_final = df_final.rename(
+        columns={
+            "time": "timestamp",
+            "open": "open_price",
+            "close": "close_price",
+            "high": "high_price",
+            "low": "low_price",
+        }
+    )
+    for column in ["open_price", "close_price", "high_price", "low_price"]:
+        df_final[column] = pd.to_numeric(df_final[column], errors="coerce")
+    return df_final
+
+
+def main():
+    for n_candles in (100, 1000):
+        body = make_bingx_body(n_candles)
+
+        old = decode_pandas(body)
+        new = decode_bingx_klines(body)
+        assert np.allclose(old["close_price"].to_numpy(), new[2])
+        assert np.array_equal(old["timestamp"].to_numpy(), new[0].astype(np.int64))
+
+        n_runs = 200
+        t_old = timeit.timeit(lambda: decode_pandas(body), number=n_runs) / n_runs
+        t_new = timeit.timeit(lambda: decode_bingx_klines(body), number=n_runs) / n_runs
+        print(
+            f"{n_candles} nến: pandas {t_old * 1e6:.0f} µs, "
+            f"decode.py {t_new * 1e6:.0f} µs, nhanh hơn {t_old / t_new:.1f}x "
+            f"(orjson: {orjson is not None})"
+        )
+
+
+if __name__ == "__main__":
+    main()
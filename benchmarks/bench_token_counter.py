@@ -0,0 +1,98 @@
+"""So sánh chi phí đếm token mỗi delta khi stream câu trả lời
+
+Đường cũ gọi tiktoken.encoding_for_model và encode lại toàn bộ câu trả lời ở
+mỗi delta nên chi phí tăng theo độ dài câu trả lời; StreamTokenCounter chỉ
+encode phần đuôi nên chi phí mỗi delta gần như không đổi.
+
+Chạy từ thư mục gốc của repo:
+
+    python benchmarks/bench_token_counter.py
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+
+import tiktoken
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+from token_counter import StreamTokenCounter  # noqa: E402
+
+MODEL = "gpt-4o-mini"
+MESSAGES = [
+    {"role": "system", "content": "You are a crypto trading assistant."},
+    {"role": "user", "content": "Analyze this trader for me."},
+]
+
+
+def make_deltas(n_chars, seed=0):
+    rng = random.Random(seed)
+    words = (
+        "the trader opens long positions with high leverage and takes profit "
+        "early while stop loss is rarely used 12.5% ROI 🚀 đòn bẩy lợi nhuận\n"
+    ).split(" ")
+    text = ""
+    while len(text) < n_chars:
+        text += rng.choice(words) + " "
+    deltas = []
+    i = 0
+    while i < len(text):
+        n = rng.randint(2, 8)
+        deltas.append(text[i : i + n])
+        i += n
+    return deltas
+
+
+def count_old(deltas):
+    """Đường cũ của send_message_stream, trả về thời gian (s) của từng delta"""
+    timings = []
+    answer = ""
+    for delta in deltas:
+        start = time.perf_counter()
+        answer += delta
+        encoding = tiktoken.encoding_for_model(MODEL)
+        n_output_tokens = 1 + len(encoding.encode(answer))
+        timings.append(time.perf_counter() - start)
+    return n_output_tokens, timings
+
+
+def count_new(deltas):
+    timings = []
+    counter = StreamTokenCounter(MESSAGES, MODEL)
+    for delta in deltas:
+        start = time.perf_counter()
+        counter.add(delta)
+        timings.append(time.perf_counter() - start)
+    return counter.finish()[1], timings
+
+
+def mean_us(timings):
+    return sum(timings) / len(timings) * 1e6
+
+
+def main():
+    # nạp encoding trước để không tính thời gian tải file BPE
+    tiktoken.encoding_for_model(MODEL)
+
+    deltas = make_deltas(16000)
+    n_old, old = count_old(deltas)
+    n_new, new = count_new(deltas)
+    assert n_old == n_new, (n_old, n_new)
+
+    n = len(deltas)
+    print(f"{n} delta, {n_new} token output")
+    for name, lo, hi in [
+        ("đầu", 0, n // 10),
+        ("giữa", n // 2 - n // 20, n // 2 + n // 20),
+        ("cuối", n - n // 10, n),
+    ]:
+        print(
+            f"{name:>5}: cũ {mean_us(old[lo:hi]):8.1f} µs/delta, "
+            f"mới {mean_us(new[lo:hi]):6.1f} µs/delta"
+        )
+
+
+if __name__ == "__main__":
+    main()
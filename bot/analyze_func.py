@@ -1,26 +1,58 @@
 from dotenv import load_dotenv
 import os
+import numpy as np
 import pandas as pd
-import requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import partial
 import config
+from candle_store import CandleStore, candles_to_frame
+from decode import (
+    POSITION_SCHEMA,
+    STRATEGY_SCHEMA,
+    decode_bingx_klines,
+    decode_bitget_klines,
+    decode_records,
+    loads,
+)
+from graphql_batch import GraphQLBatcher
+from http_client import HttpClient
+from position_kernel import (
+    build_candle_buffer,
+    build_candle_seconds,
+    compute_positions_metrics,
+)
+from query_cache import QueryCache
 
 
 load_dotenv(".env", override=True)
 BINGX_API_URL = config.bingx_api_url
+BITGET_API_URL = config.bitget_api_url
 DEV_GRAPHQL_API = config.dev_graphql_api
+CANDLE_FETCH_CONCURRENCY = config.candle_fetch_concurrency
+candle_store = CandleStore()
+http_client = HttpClient()
+# nơi lưu chỉ số của vị thế đã đóng (database.Database), được gán ở bot.py
+position_metric_store = None
 
 
-def connect_copin_api(query):
-    """Kết nối vào API của copin để lấy thông tin"""
-    url = DEV_GRAPHQL_API
-
+def send_copin_query(query):
+    """Gửi một document GraphQL tới API của copin, trả về JSON của response"""
     payload = {
         "query": query,
     }
+    response = http_client.post(DEV_GRAPHQL_API, endpoint="copin_graphql", json=payload)
+    return loads(response.content)
+
+
+copin_batcher = GraphQLBatcher(send_copin_query)
+copin_cache = QueryCache()
+
+
+def connect_copin_api(query):
+    """Kết nối vào API của copin để lấy thông tin"""
     try:
-        response = requests.post(url, json=payload)
-        data = response.json()
+        data = send_copin_query(query)
         df = pd.DataFrame(data["data"])
 
         df.rename(columns={df.columns[0]: "copin"}, inplace=True)
@@ -34,76 +66,58 @@ def connect_copin_api(query):
         return result
 
 
-def query_strategy_day_trading():
-    query = f"""
-    query {{
-        searchPositionStatistic(
-            index: "copin.position_statistics"
-            body: {{
-            filter: {{
-                and: [
+def fetch_copin_field(field):
+    """Kết quả JSON của một field GraphQL, đọc từ copin_cache nếu còn hạn
 
-                {{ field: "type", match: "D30" }}
-                {{ field: "avgDuration"
-                    gte : "3600"
-                    lte : "7200"
-                }}
-                ]
-            }}
-            sorts: [{{ field: "realisedPnl", direction: "desc" }}]
-            paging: {{ size: 500, from: 0 }}
-            }}
-        ) {{
-            data {{  
-                account
-                protocol
-                
-                avgDuration     
-                totalTrade
-                realisedPnl
-                realisedAvgRoi
-            }}
-            meta {{
-                total
-                limit
-                offset
-                totalPages
-            }}
-        }}
-    }}
+    Khi cache miss, field được gửi qua copin_batcher để gộp chung request với
+    các lời gọi đồng thời.
     """
-    result = connect_copin_api(query)
-    return result
+    return copin_cache.get_or_fetch(field, copin_batcher.query)
 
 
-def query_strategy_scalping():
-    query = f"""
-    query {{
+def query_copin_field(field, schema=None):
+    """Lấy kết quả của một field GraphQL dưới dạng DataFrame, có kiểu theo schema"""
+    try:
+        records = fetch_copin_field(field)["data"]
+        if schema is None:
+            df_result = pd.DataFrame(records)
+        else:
+            df_result = pd.DataFrame(decode_records(records, schema), copy=False)
+
+        return df_result
+    except Exception as e:
+        result = "GraphQL bị lỗi"
+
+        return result
+
+
+STRATEGY_FIELDS = list(STRATEGY_SCHEMA)
+# điều kiện lọc avgDuration của từng strategy trong list_strategy.yml
+STRATEGY_FILTERS = {
+    "day_trading": '{ field: "avgDuration", gte: "3600", lte: "7200" }',
+    "scalping": '{ field: "avgDuration", lte: "3600" }',
+}
+
+
+def query_position_statistic_page(filters, fields, offset, size):
+    """Lấy một trang searchPositionStatistic, trả về (list record, meta)"""
+    filters = "\n".join(filters)
+    fields = "\n".join(fields)
+    field = f"""
         searchPositionStatistic(
             index: "copin.position_statistics"
             body: {{
             filter: {{
                 and: [
-
-                {{ field: "type", match: "D30" }}
-                {{ field: "avgDuration"
-                    
-                    lte : "3600"
-                }}
+                {filters}
                 ]
             }}
             sorts: [{{ field: "realisedPnl", direction: "desc" }}]
-            paging: {{ size: 500, from: 0 }}
+            paging: {{ size: {size}, from: {offset} }}
             }}
         ) {{
-            data {{  
-                account
-                protocol
-                
-                avgDuration     
-                totalTrade
-                realisedPnl
-                realisedAvgRoi
+            data {{
+                {fields}
             }}
             meta {{
                 total
@@ -112,16 +126,78 @@ def query_strategy_scalping():
                 totalPages
             }}
         }}
-    }}
     """
-    result = connect_copin_api(query)
+    result = fetch_copin_field(field)
+    return result["data"], result["meta"]
+
+
+def iter_position_statistic_pages(filters, schema, page_size=None):
+    """Duyệt toàn bộ kết quả searchPositionStatistic theo từng trang
+
+    Mỗi trang được trả về dưới dạng dict cột numpy có kiểu theo `schema`. Trang
+    kế tiếp được tải trước trong lúc trang hiện tại đang được xử lý, nên bộ nhớ
+    chỉ giữ tối đa hai trang.
+    """
+    if page_size is None:
+        page_size = config.copin_page_size
+    fields = [key for key, _ in schema.values()]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(
+            query_position_statistic_page, filters, fields, 0, page_size
+        )
+        page = 0
+        while future is not None:
+            records, meta = future.result()
+            page += 1
+            if records and page < meta["totalPages"]:
+                future = executor.submit(
+                    query_position_statistic_page,
+                    filters,
+                    fields,
+                    page * page_size,
+                    page_size,
+                )
+            else:
+                future = None
+            if records:
+                yield decode_records(records, schema)
+
+
+def iter_strategy(strategy, page_size=None):
+    """Duyệt toàn bộ trader thoả mãn strategy, mỗi lần một trang cột"""
+    filters = ['{ field: "type", match: "D30" }', STRATEGY_FILTERS[strategy]]
+    return iter_position_statistic_pages(filters, STRATEGY_SCHEMA, page_size)
+
+
+def query_strategy(strategy):
+    try:
+        chunks = [pd.DataFrame(chunk) for chunk in iter_strategy(strategy)]
+    except Exception as e:
+        result = "GraphQL bị lỗi"
+
+        return result
+
+    if not chunks:
+        return pd.DataFrame(columns=STRATEGY_FIELDS)
+    result = pd.concat(chunks, ignore_index=True)
+    result["protocol"] = result["protocol"].astype("category")
+    return result
+
+
+def query_strategy_day_trading():
+    result = query_strategy("day_trading")
+    return result
+
+
+def query_strategy_scalping():
+    result = query_strategy("scalping")
     return result
 
 
 def query_position_statistics(account, type):
     """Lấy position statistics của trader"""
-    query = f"""
-    query {{
+    field = f"""
         searchPositionStatistic(
             index: "copin.position_statistics"
             body: {{
@@ -158,9 +234,8 @@ def query_position_statistics(account, type):
                 totalPages
             }}
         }}
-    }}
     """
-    result = connect_copin_api(query)
+    result = query_copin_field(field)
     return result
 
 
@@ -287,10 +362,16 @@ def analyze_real_position(account):
         return recent_stats
 
 
-def query_position(account):
-    """Trả lại list 20 vị thế của trader với những chỉ số cần thiết"""
-    query = f"""
-        query {{
+def query_position(account, closed_after=None):
+    """Trả lại list 20 vị thế của trader với những chỉ số cần thiết
+
+    Nếu có closed_after (timestamp ms) thì chỉ lấy vị thế đóng sau thời điểm đó.
+    """
+    closed_after_filter = ""
+    if closed_after is not None:
+        iso_date = format_timestamp(closed_after + 1)
+        closed_after_filter = f'{{ field: "closeBlockTime", gte: "{iso_date}" }}'
+    field = f"""
             searchTopOpeningPosition(
                 index: "copin.positions"
                 protocols: [
@@ -332,6 +413,7 @@ def query_position(account):
                             field: "account", match: "{account}"
                         }}
                         {{ field: "orderCount", match: "2" }}
+                        {closed_after_filter}
                         ]
                     }}
                     sorts: [{{ field: "closeBlockTime", direction: "desc" }}]
@@ -362,10 +444,11 @@ def query_position(account):
                     totalPages
                 }}
             }}
-        }}
     """
 
-    result = connect_copin_api(query)
+    result = query_copin_field(field, POSITION_SCHEMA)
+    if isinstance(result, pd.DataFrame):
+        result = prepare_positions(result)
     return result
 
 
@@ -377,6 +460,28 @@ def convert_timestamp(time):
     return timestamp
 
 
+def parse_timestamps(values):
+    """Chuyển cả mảng isodate sang timestamp int64 (ms) trong một lần gọi"""
+    parsed = pd.to_datetime(pd.Series(values), utc=True, format="ISO8601")
+    return parsed.to_numpy("datetime64[ms]").astype(np.int64)
+
+
+def format_timestamp(timestamp):
+    """Chuyển timestamp (ms) sang isodate UTC như định dạng của copin"""
+    iso_date = pd.Timestamp(timestamp, unit="ms", tz="UTC")
+    return iso_date.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def prepare_positions(list_position):
+    """Áp schema cho bảng vị thế: thời gian int64 ms, pair dạng category"""
+    list_position["openBlockTime"] = parse_timestamps(list_position["openBlockTime"])
+    list_position["closeBlockTime"] = parse_timestamps(list_position["closeBlockTime"])
+    list_position["pair"] = (
+        list_position["pair"].astype(str).str.replace('"', "").astype("category")
+    )
+    return list_position
+
+
 def check_interval(duration):
     """Chọn interval phù hợp để khi connect API dữ liệu không quá limit"""
     if (duration / 60) <= 1000:
@@ -393,7 +498,8 @@ def check_interval(duration):
         return "1d"
 
 
-def connect_price_API_BINGX(pair, interval, open_time, close_time, limit: int = 1000):
+def fetch_klines_BINGX(pair, interval, open_time, close_time, limit: int = 1000):
+    """Tải nến từ BingX, trả về mảng float64 (5, n) theo STORE_COLUMNS"""
     APIURL = BINGX_API_URL
     pair_mapping = {
         "RNDR-USDT": "RENDER-USDT",
@@ -421,26 +527,18 @@ def connect_price_API_BINGX(pair, interval, open_time, close_time, limit: int =
     # URL của API endpoint
 
     # Gửi yêu cầu GET với paramsMap
-    response = requests.get(APIURL, params=paramsMap)
-
-    data = response.json()
-    df = pd.DataFrame(data["data"])
-    df_final = df.sort_index(ascending=False).reset_index(drop=True)
-    df_final.drop(["volume"], axis=1, inplace=True)
-
-    df_final = df_final.rename(
-        columns={
-            "time": "timestamp",
-            "open": "open_price",
-            "close": "close_price",
-            "high": "high_price",
-            "low": "low_price",
-        }
-    )
-    return df_final
+    response = http_client.get(APIURL, endpoint="bingx", params=paramsMap)
 
+    return decode_bingx_klines(response.content)
 
-def connect_price_API_BITGET(pair, interval, open_time, close_time, limit: int = 1000):
+
+def connect_price_API_BINGX(pair, interval, open_time, close_time, limit: int = 1000):
+    candles = fetch_klines_BINGX(pair, interval, open_time, close_time, limit)
+    return candles_to_frame(candles)
+
+
+def fetch_klines_BITGET(pair, interval, open_time, close_time, limit: int = 1000):
+    """Tải nến từ Bitget, trả về mảng float64 (5, n) theo STORE_COLUMNS"""
     APIURL = BITGET_API_URL
     pair_mapping = {
         "RNDRUSDT": "RENDERUSDT",
@@ -470,23 +568,14 @@ def connect_price_API_BITGET(pair, interval, open_time, close_time, limit: int =
     }
 
     # Gửi yêu cầu GET với paramsMap
-    response = requests.get(APIURL, params=paramsMap)
-
-    data = response.json()
-    df = pd.DataFrame(
-        data["data"],
-        columns=[
-            "timestamp",
-            "open_price",
-            "high_price",
-            "low_price",
-            "close_price",
-            "volume_coins",
-            "volume_currency",
-        ],
-    )
-    df_final = df[["timestamp", "open_price", "close_price", "high_price", "low_price"]]
-    return df_final
+    response = http_client.get(APIURL, endpoint="bitget", params=paramsMap)
+
+    return decode_bitget_klines(response.content)
+
+
+def connect_price_API_BITGET(pair, interval, open_time, close_time, limit: int = 1000):
+    candles = fetch_klines_BITGET(pair, interval, open_time, close_time, limit)
+    return candles_to_frame(candles)
 
 
 def interval_to_second(interval):
@@ -505,25 +594,54 @@ def interval_to_second(interval):
 
 
 def check_price_crypto(protocol, pair, interval, open_time, close_time):
+    """Lấy nến của vị thế, ưu tiên dữ liệu đã lưu trong candle_store"""
     if protocol == "BINGX":
-        price_crypto = connect_price_API_BINGX(pair, interval, open_time, close_time)
+        fetch = fetch_klines_BINGX
 
     elif protocol == "BITGET":
-        price_crypto = connect_price_API_BITGET(pair, interval, open_time, close_time)
-
-    price_crypto["open_price"] = pd.to_numeric(
-        price_crypto["open_price"], errors="coerce"
-    )
-    price_crypto["close_price"] = pd.to_numeric(
-        price_crypto["close_price"], errors="coerce"
+        fetch = fetch_klines_BITGET
+
+    price_crypto = candle_store.get_candles(
+        protocol,
+        pair,
+        interval,
+        interval_to_second(interval),
+        open_time,
+        close_time,
+        fetch,
     )
-    price_crypto["high_price"] = pd.to_numeric(
-        price_crypto["high_price"], errors="coerce"
+    return price_crypto
+
+
+def compute_position_metrics(
+    price_crypto,
+    interval,
+    open_time,
+    close_time,
+    isLong,
+    isWin,
+    leverage,
+):
+    """Tính các chỉ số của một vị thế từ dữ liệu nến đã tải"""
+    candles, offsets = build_candle_buffer([price_crypto])
+    interval_seconds = [interval_to_second(interval)]
+    metrics = compute_positions_metrics(
+        candles,
+        offsets,
+        [open_time],
+        [close_time],
+        [isLong],
+        [isWin],
+        [leverage],
+        interval_seconds,
+        build_candle_seconds([price_crypto], interval_seconds),
     )
-    price_crypto["low_price"] = pd.to_numeric(
-        price_crypto["low_price"], errors="coerce"
+    roi_final, loss_Handling, TPEfficiency, min_roi, max_roi = (
+        None if np.isnan(metrics[name][0]) else metrics[name][0]
+        for name in ("RoiFinal", "LossHandling", "TPEfficiency", "MinRoi", "MaxRoi")
     )
-    return price_crypto
+
+    return (roi_final, loss_Handling, TPEfficiency, min_roi, max_roi)
 
 
 def analyze_position(
@@ -540,174 +658,310 @@ def analyze_position(
         price_crypto = check_price_crypto(
             protocol, pair, interval, open_time, close_time
         )
+    except Exception as e:
+        print(e)
+        print(pair)
+        return (None, None, None, None, None)
+
+    return compute_position_metrics(
+        price_crypto, interval, open_time, close_time, isLong, isWin, leverage
+    )
 
-        buy_price = price_crypto["open_price"][0]
 
-        analyze_position = pd.DataFrame({"timestamp": price_crypto["timestamp"]})
+def fetch_candles_concurrently(protocol, windows, max_workers=None):
+    """Tải nến cho nhiều vị thế cùng lúc, trả kết quả theo thứ tự hoàn thành
 
-        roi_close = ((price_crypto["close_price"] / buy_price) - 1) * leverage * 100
-        roi_high = ((price_crypto["high_price"] / buy_price) - 1) * leverage * 100
-        roi_low = ((price_crypto["low_price"] / buy_price) - 1) * leverage * 100
-        if isLong == True:
-            analyze_position["roi_close"] = roi_close
-            analyze_position["roi_high"] = roi_high
-            analyze_position["roi_low"] = roi_low
-        else:
-            analyze_position["roi_close"] = -roi_close
-            analyze_position["roi_high"] = -roi_low
-            analyze_position["roi_low"] = -roi_high
+    `windows` là dict {key: (pair, interval, open_time, close_time)}. Mỗi phần tử
+    trả về là (key, price_crypto), price_crypto là None nếu request bị lỗi.
+    """
+    if max_workers is None:
+        max_workers = CANDLE_FETCH_CONCURRENCY
+    if not windows:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(windows))) as executor:
+        futures = {
+            executor.submit(check_price_crypto, protocol, *window): key
+            for key, window in windows.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                yield key, future.result()
+            except Exception as e:
+                print("Đã xảy ra lỗi:", e)
+                print(windows[key])
+                yield key, None
 
-        analyze_position["BH"] = analyze_position["roi_close"] < 0
 
-        max_streak = (analyze_position["BH"] != analyze_position["BH"].shift()).cumsum()
-        longest_lose_streak = (
-            analyze_position[analyze_position["BH"]].groupby(max_streak).size().max()
-        )
+def plan_candle_requests(windows, max_bars=1000, max_gap_bars=None):
+    """Gộp các cửa sổ nến chồng lấn hoặc gần nhau của cùng (pair, interval)
 
-        roi_final = analyze_position["roi_close"].iloc[-1]
+    Trả về dict {request_key: ((pair, interval, start, end), [window keys])}, mỗi
+    request không vượt quá max_bars nến để vừa với limit của API.
+    """
+    if max_gap_bars is None:
+        max_gap_bars = config.candle_merge_gap_bars
+
+    by_series = {}
+    for key, (pair, interval, open_time, close_time) in windows.items():
+        by_series.setdefault((pair, interval), []).append((open_time, close_time, key))
+
+    requests_plan = {}
+    for (pair, interval), series_windows in by_series.items():
+        interval_ms = interval_to_second(interval) * 1000
+        series_windows.sort()
+        group_start, group_end, group_keys = None, None, []
+        for open_time, close_time, key in series_windows:
+            if group_keys:
+                near = open_time - group_end <= max_gap_bars * interval_ms
+                merged_bars = (max(group_end, close_time) - group_start) / interval_ms
+                if near and merged_bars + 1 <= max_bars:
+                    group_end = max(group_end, close_time)
+                    group_keys.append(key)
+                    continue
+                requests_plan[len(requests_plan)] = (
+                    (pair, interval, group_start, group_end),
+                    group_keys,
+                )
+            group_start, group_end, group_keys = open_time, close_time, [key]
+        requests_plan[len(requests_plan)] = (
+            (pair, interval, group_start, group_end),
+            group_keys,
+        )
 
-        min_roi = analyze_position["roi_low"].min()
-        max_roi = analyze_position["roi_high"].max()
+    return requests_plan
 
-        exist_BH = (analyze_position["BH"] == True).any()
 
-        if exist_BH:
-            duration_second_interval = interval_to_second(interval)
+def fetch_position_candles(protocol, windows, max_workers=None):
+    """Tải nến cho các vị thế với số request ít nhất rồi cắt lại cho từng vị thế
 
-            total_lose_duration = (
-                analyze_position["BH"].sum() * duration_second_interval
+    Trả về (key, price_crypto) theo thứ tự hoàn thành như
+    fetch_candles_concurrently.
+    """
+    requests_plan = plan_candle_requests(windows)
+    request_windows = {
+        request_key: request_window
+        for request_key, (request_window, _) in requests_plan.items()
+    }
+    for request_key, price_crypto in fetch_candles_concurrently(
+        protocol, request_windows, max_workers
+    ):
+        for key in requests_plan[request_key][1]:
+            if price_crypto is None:
+                yield key, None
+                continue
+            _, _, open_time, close_time = windows[key]
+            timestamps = price_crypto["timestamp"]
+            in_window = (timestamps >= open_time) & (timestamps <= close_time)
+            yield key, price_crypto[in_window].reset_index(drop=True)
+
+
+def refine_position_candles(protocol, windows, fetched):
+    """Làm mịn nến thô ở điểm vào, điểm ra và các nến chứa giá cao/thấp nhất
+
+    Với mỗi vị thế dùng interval lớn hơn 1m, các nến đó được thay bằng nến của
+    interval nhỏ nhất vẫn vừa limit của API (1m, riêng 1d là 5m). Nến vào lệnh
+    được tải từ đúng open_time, nến cuối bị cắt tại close_time. Cột bar_seconds
+    ghi độ dài của từng nến để tính LossTime cho chuỗi nhiều khung thời gian.
+    """
+    refine_windows = {}
+    for key, price_crypto in fetched.items():
+        pair, interval, open_time, close_time = windows[key]
+        if interval == "1m" or price_crypto.empty:
+            continue
+        interval_ms = interval_to_second(interval) * 1000
+        # nến đầu có thể kéo dài gần hai interval tính từ open_time
+        fine_interval = check_interval(interval_to_second(interval) * 2)
+        timestamps = price_crypto["timestamp"]
+        bars = {
+            0,
+            len(price_crypto) - 1,
+            int(price_crypto["high_price"].to_numpy().argmax()),
+            int(price_crypto["low_price"].to_numpy().argmin()),
+        }
+        for bar in bars:
+            start = open_time if bar == 0 else int(timestamps[bar])
+            end = min(int(timestamps[bar]) + interval_ms - 1, close_time)
+            refine_windows[(key, bar)] = (pair, fine_interval, start, end)
+
+    refined = {}
+    for (key, bar), fine in fetch_candles_concurrently(protocol, refine_windows):
+        if fine is not None and not fine.empty:
+            refined.setdefault(key, {})[bar] = fine.assign(
+                bar_seconds=interval_to_second(refine_windows[(key, bar)][1])
             )
-            total_lose_streak_duration = longest_lose_streak * duration_second_interval
-            ##LossTime
-            loss_time = (total_lose_duration * 1000 / (close_time - open_time)) * 100
-
-            ###ConsecutiveLossTime
-            consecutive_loss_time = (
-                total_lose_streak_duration * 1000 / (close_time - open_time)
-            ) * 100
-            ##LossHandling
-
-            if isWin == True:
-                loss_Handling = min_roi
-            else:
-                loss_Handling = None
 
-        else:
-            loss_time = None
-            consecutive_loss_time = None
-            loss_Handling = None
+    result = dict(fetched)
+    for key, fine_bars in refined.items():
+        price_crypto = fetched[key]
+        keep = np.ones(len(price_crypto), dtype=bool)
+        keep[list(fine_bars)] = False
+        coarse = price_crypto[keep].assign(
+            bar_seconds=interval_to_second(windows[key][1])
+        )
+        result[key] = (
+            pd.concat([coarse] + list(fine_bars.values()))
+            .sort_values("timestamp")
+            .reset_index(drop=True)
+        )
+    return result
 
-        if isWin == True:
-            ##TPEfficiency
-            TPEfficiency = roi_final / max_roi * 100
 
-        else:
-            TPEfficiency = None
+# cột chỉ số của từng vị thế, NaN khi không tính được
+POSITION_METRICS = [
+    "RoiFinal",
+    "TPEfficiency",
+    "TPLate",
+    "LossHandling",
+    "MinRoi",
+    "MaxRoi",
+]
+POSITION_COLUMNS = list(POSITION_SCHEMA) + POSITION_METRICS
 
-        # TP_Late
-        exist_tp = (analyze_position["roi_close"] > 0).any()
-        if exist_tp:
-            index_max_roi = analyze_position["roi_high"].idxmax()
-            timestamp_max = int(analyze_position.loc[index_max_roi, "timestamp"])
 
-            if timestamp_max < close_time:
-                TP_Late = True
+def compute_position_frame_metrics(list_position, protocol):
+    """Tính các cột POSITION_METRICS cho bảng vị thế từ nến của từng vị thế"""
+    return _compute_position_frame_metrics(list_position, protocol)[0]
 
-            else:
-                TP_Late = False
 
-        else:
-            TP_Late = None
-    except Exception as e:
-        print(e)
-        print(pair)
-        (
-            roi_final,
-            loss_Handling,
-            TPEfficiency,
-            TP_Late,
-        ) = (None, None, None, None)
+def _compute_position_frame_metrics(list_position, protocol):
+    """Như compute_position_frame_metrics, kèm mảng bool các vị thế đã tải được nến
 
-    return (roi_final, loss_Handling, TPEfficiency, min_roi, max_roi)
+    Vị thế tải lỗi có chỉ số NaN và False trong mảng; vị thế đã tải nhưng sàn
+    không có nến (ví dụ cặp không niêm yết) cũng có chỉ số NaN nhưng là True.
+    """
+    n_positions = len(list_position)
+    list_position = list_position.reset_index(drop=True).assign(
+        **{column: np.full(n_positions, np.nan) for column in POSITION_METRICS}
+    )
+    open_times = list_position["openBlockTime"].to_numpy()
+    close_times = list_position["closeBlockTime"].to_numpy()
+    intervals = [
+        check_interval(duration) for duration in list_position["durationInSecond"]
+    ]
+    windows = {
+        index_1: (pair, interval, int(open_time), int(close_time))
+        for index_1, (pair, interval, open_time, close_time) in enumerate(
+            zip(list_position["pair"], intervals, open_times, close_times)
+        )
+    }
 
+    # Tải nến của tất cả vị thế song song (gộp các cửa sổ chồng lấn) rồi tính
+    # chỉ số cho cả lô một lần
+    fetched = {
+        index_1: price_crypto
+        for index_1, price_crypto in fetch_position_candles(protocol, windows)
+        if price_crypto is not None
+    }
+    if config.candle_refine_extremes:
+        fetched = refine_position_candles(protocol, windows, fetched)
+    indexes = np.array([i for i in windows if i in fetched], dtype=np.int64)
+    candles, offsets = build_candle_buffer([fetched[i] for i in indexes])
+    interval_seconds = [interval_to_second(intervals[i]) for i in indexes]
+    metrics = compute_positions_metrics(
+        candles,
+        offsets,
+        open_times[indexes],
+        close_times[indexes],
+        list_position["isLong"].to_numpy()[indexes],
+        list_position["isWin"].to_numpy()[indexes],
+        list_position["leverage"].to_numpy()[indexes],
+        interval_seconds,
+        build_candle_seconds([fetched[i] for i in indexes], interval_seconds),
+    )
+    for column in POSITION_METRICS:
+        values = list_position[column].to_numpy(copy=True)
+        values[indexes] = metrics[column]
+        list_position[column] = values
+    candles_fetched = np.zeros(n_positions, dtype=bool)
+    candles_fetched[indexes] = True
+    return list_position, candles_fetched
 
-def analyze_trader(account, protocol):
-    """Hâm phân tích trader"""
 
-    trader = pd.DataFrame({"account": [account]})
+def load_position_metrics(account, protocol):
+    """20 vị thế gần nhất của trader kèm chỉ số
 
-    trader = trader.assign(
-        avgRoiFinal=None,
-        avgLossROI=None,
-        avgTPEfficiency=None,
-        avgLossHandling=None,
-        winRate=None,
-        profitFactor=None,
-        avgLeverage=None,
-        winStreak=None,
-        loseStreak=None,
-    )
+    Khi có position_metric_store, chỉ những vị thế đóng sau vị thế mới nhất đã
+    lưu mới được tải và tính, phần còn lại đọc từ store.
+    """
+    if position_metric_store is not None:
+        try:
+            return _load_position_metrics_incremental(account, protocol)
+        except Exception as e:
+            print("Position metric store bị lỗi:", e)
 
     list_position = query_position(account)
+    if isinstance(list_position, str) or list_position.empty:
+        return list_position
+    return compute_position_frame_metrics(list_position, protocol)
 
-    if list_position.empty | isinstance(list_position, str):
-        print(f"account ko co data : {account}")
-        return "Không tìm thấy dữ liệu về trader này", "Không có vị thế nào cả"
 
-    else:
-        list_position = list_position.assign(
-            RoiFinal=None,
-            TPEfficiency=None,
-            TPLate=None,
-            LossHandling=None,
-            MinRoi=None,
-            MaxRoi=None,
+def _load_position_metrics_incremental(account, protocol):
+    latest_close_time = position_metric_store.get_latest_position_close_time(
+        account, protocol
+    )
+    new_positions = query_position(account, closed_after=latest_close_time)
+    if isinstance(new_positions, str):
+        return new_positions
+
+    pending = pd.DataFrame(columns=POSITION_COLUMNS)
+    if not new_positions.empty:
+        new_positions, fetched = _compute_position_frame_metrics(
+            new_positions, protocol
         )
-        for index_1, row_1 in list_position.iterrows():
-            open_time = convert_timestamp(list_position.at[index_1, "openBlockTime"])
-            close_time = convert_timestamp(list_position.at[index_1, "closeBlockTime"])
-
-            duration_position = list_position.at[index_1, "durationInSecond"]
-            pair = list_position.at[index_1, "pair"]
-            pair = pair.replace('"', "")
-            leverage = list_position.at[index_1, "leverage"]
+        new_positions = new_positions.astype({"pair": str})
+        # chỉ lưu vị thế đã tải được nến và đóng trước vị thế tải lỗi cũ nhất,
+        # để lần sau closed_after vẫn lấy lại vị thế lỗi. Vị thế không có nến
+        # trên sàn vẫn được lưu (chỉ số NaN) để mốc thời gian đi tiếp được
+        close_times = new_positions["closeBlockTime"].to_numpy()
+        persist = fetched.copy()
+        if not fetched.all():
+            persist &= close_times < close_times[~fetched].min()
+        records = new_positions[persist].to_dict("records")
+        if records:
+            position_metric_store.upsert_position_metrics(account, protocol, records)
+        pending = new_positions[~persist]
+
+    records = position_metric_store.get_position_metrics(account, protocol, limit=20)
+    stored = pd.DataFrame(records, columns=POSITION_COLUMNS)
+    if pending.empty:
+        return stored
+    list_position = pd.concat([pending[POSITION_COLUMNS], stored], ignore_index=True)
+    list_position = list_position.sort_values("closeBlockTime", ascending=False)
+    return list_position.head(20).reset_index(drop=True)
+
+
+def analyze_trader_stats(account, protocol):
+    """Tính bảng chỉ số một dòng của trader, trả None nếu trader không có vị thế"""
 
-            interval = check_interval(duration_position)
-            isLong = row_1["isLong"]
-            isWin = row_1["isWin"]
+    trader = pd.DataFrame({"account": [account]})
 
-            try:
+    trader = trader.assign(
+        avgRoiFinal=np.nan,
+        avgLossROI=np.nan,
+        avgTPEfficiency=np.nan,
+        avgLossHandling=np.nan,
+        winRate=np.nan,
+        profitFactor=np.nan,
+        avgLeverage=np.nan,
+        winStreak=None,
+        loseStreak=None,
+    )
 
-                (roi_final, loss_Handling, TPEfficiency, min_roi, max_roi) = (
-                    analyze_position(
-                        pair,
-                        interval,
-                        open_time,
-                        close_time,
-                        isLong,
-                        isWin,
-                        leverage,
-                        protocol,
-                    )
-                )
-                list_position.at[index_1, "RoiFinal"] = roi_final
-                list_position.at[index_1, "LossHandling"] = loss_Handling
-                list_position.at[index_1, "TPEfficiency"] = TPEfficiency
-                list_position.at[index_1, "MinRoi"] = min_roi
-                list_position.at[index_1, "MaxRoi"] = max_roi
+    list_position = load_position_metrics(account, protocol)
 
-            except Exception as e:
-                print("Đã xảy ra lỗi:", e)
-                print(
-                    f"'{pair}','{interval}',{open_time},{close_time},{isLong},{isWin},{leverage}"
-                )
-                pass
+    if isinstance(list_position, str) or list_position.empty:
+        print(f"account ko co data : {account}")
+        return None
 
+    else:
         ##AverageRoiFinal
         trader["avgRoiFinal"] = list_position["RoiFinal"].mean()
 
         ##AverageLossROI
 
+        loss_roi = np.nan
         exists_loss = (list_position["isWin"] == False).any()
         if exists_loss:
             loss_ROI = list_position[list_position["isWin"] == False]["RoiFinal"]
@@ -750,28 +1004,113 @@ def analyze_trader(account, protocol):
         take_profit = list_position["MaxRoi"].mean()
         trader["TakeProfit"] = take_profit
 
-        list_position_2 = list_position.drop(
-            ["openBlockTime", "closeBlockTime"], axis=1
-        )
         # stop_loss
         if avgLossHandling > loss_roi:
-            stop_loss = trader["avgLossHandling"]
+            stop_loss = avgLossHandling
         else:
-            stop_loss = trader["avgLossROI"]
+            stop_loss = loss_roi
         trader["stopLoss"] = stop_loss
         # Reverse copy
         reverse_copy = False
-        if loseStreak | trader["winRate"] <= 0.5:
+        if loseStreak or trader.at[0, "winRate"] <= 0.5:
             reverse_copy = True
             trader["TakeProfit"] = -stop_loss
             trader["stopLoss"] = -take_profit
+        trader["reverseCopy"] = reverse_copy
+
+    return trader
 
-        result = []
-        result.append(
-            reverse_copy,
-            trader["avgLeverage"],
-            trader["TakeProfit"],
-            trader["stopLoss"],
-        )
 
+def analyze_trader(account, protocol):
+    """Hâm phân tích trader"""
+    trader = analyze_trader_stats(account, protocol)
+    if trader is None:
+        return "Không tìm thấy dữ liệu về trader này", "Không có vị thế nào cả"
+
+    result = [
+        trader.at[0, "reverseCopy"],
+        trader.at[0, "avgLeverage"],
+        trader.at[0, "TakeProfit"],
+        trader.at[0, "stopLoss"],
+    ]
     return result
+
+
+TRADER_RESULT_DTYPES = {
+    "account": "string",
+    "avgRoiFinal": "float64",
+    "avgLossROI": "float64",
+    "avgTPEfficiency": "float64",
+    "avgLossHandling": "float64",
+    "winRate": "float64",
+    "profitFactor": "float64",
+    "avgLeverage": "float64",
+    "winStreak": "boolean",
+    "loseStreak": "boolean",
+    "TakeProfit": "float64",
+    "stopLoss": "float64",
+    "reverseCopy": "boolean",
+}
+
+
+def _init_analyze_worker():
+    """Mỗi process có candle_store và http client riêng, dùng chung cho mọi account"""
+    global candle_store, http_client, copin_batcher, copin_cache
+    global position_metric_store
+    candle_store = CandleStore()
+    http_client = HttpClient()
+    copin_batcher = GraphQLBatcher(send_copin_query)
+    copin_cache = QueryCache()
+    if position_metric_store is not None:
+        # MongoClient của process cha không dùng được sau fork, mở kết nối riêng
+        # (import ở đây vì database import analyze_func)
+        import database
+
+        position_metric_store = database.Database()
+
+
+def _analyze_account(account, protocol):
+    try:
+        trader = analyze_trader_stats(account, protocol)
+    except Exception as e:
+        print("Đã xảy ra lỗi:", e)
+        print(account)
+        trader = None
+
+    if trader is None:
+        return {"account": account}
+    return trader.iloc[0].to_dict()
+
+
+def analyze_traders(accounts, protocol, workers=None):
+    """Phân tích nhiều trader song song trên nhiều process
+
+    Trả về DataFrame một dòng cho mỗi account theo TRADER_RESULT_DTYPES, các
+    account không có dữ liệu có giá trị rỗng.
+    """
+    accounts = list(accounts)
+    if not accounts:
+        return pd.DataFrame(
+            {
+                column: pd.Series(dtype=dtype)
+                for column, dtype in TRADER_RESULT_DTYPES.items()
+            }
+        )
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunksize = max(1, len(accounts) // (workers * 4))
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_analyze_worker
+    ) as executor:
+        rows = list(
+            executor.map(
+                partial(_analyze_account, protocol=protocol),
+                accounts,
+                chunksize=chunksize,
+            )
+        )
+
+    result = pd.DataFrame(rows, columns=list(TRADER_RESULT_DTYPES))
+    return result.astype(TRADER_RESULT_DTYPES)
@@ -30,13 +30,29 @@ from telegram.constants import ParseMode, ChatAction
 import config
 import database
 import openai_utils
+import analyze_func
+from query_cache import MongoCacheTier
+from strategy_refresh import StrategyRefresher
+from stream_editor import EditScheduler
+from token_counter import with_token_count
 
 print(config.allowed_telegram_usernames)
 import base64
 from analyze_func import analyze_trader
 
 # setup
-db = database.Database()
+# pymongo for indexes, strategy ingest and jobs running in threads,
+# motor for handlers so queries don't block the event loop
+sync_db = database.Database()
+if config.graphql_cache_mongo:
+    analyze_func.copin_cache.second_tier = MongoCacheTier(
+        sync_db.graphql_cache_collection
+    )
+# analyze_trader only runs in a thread (asyncio.to_thread), so pymongo is fine here
+analyze_func.position_metric_store = sync_db
+strategy_refresher = StrategyRefresher(sync_db)
+edit_scheduler = EditScheduler()
+db = database.AsyncDatabase()
 logger = logging.getLogger(__name__)
 user_semaphores = {}
 user_tasks = {}
@@ -63,8 +79,8 @@ async def start_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
+    await db.start_new_dialog(user_id)
 
     reply_text = "Hi! I'm <b>ChatGPT</b> bot implemented with OpenAI API 🤖\n\n"
     reply_text += HELP_MESSAGE
@@ -79,7 +95,7 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
 
     text, reply_markup = get_chat_mode_menu(0)
     await update.message.reply_text(
@@ -93,7 +109,7 @@ async def show_chat_strategy_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
 
     text, reply_markup = get_chat_strategy_menu(0)
     await update.message.reply_text(
@@ -231,41 +247,41 @@ async def is_previous_message_not_answered_yet(
 async def help_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
 async def register_user_if_not_exists(
     update: Update, context: CallbackContext, user: User
 ):
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
+    if not await db.check_if_user_exists(user.id):
+        await db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
             first_name=user.first_name,
             last_name=user.last_name,
         )
-        db.start_new_dialog(user.id)
+        await db.start_new_dialog(user.id)
 
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
+    if await db.get_user_attribute(user.id, "current_dialog_id") is None:
+        await db.start_new_dialog(user.id)
 
     if user.id not in user_semaphores:
         user_semaphores[user.id] = asyncio.Semaphore(1)
 
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(
+    if await db.get_user_attribute(user.id, "current_model") is None:
+        await db.set_user_attribute(
             user.id, "current_model", config.models["available_text_models"][0]
         )
 
     # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
+    n_used_tokens = await db.get_user_attribute(user.id, "n_used_tokens")
     if isinstance(n_used_tokens, int) or isinstance(n_used_tokens, float):  # old format
         new_n_used_tokens = {
             "gpt-4o-mini": {"n_input_tokens": 0, "n_output_tokens": n_used_tokens}
         }
-        db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
+        await db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
 
     # # voice message transcription
     # if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
@@ -282,18 +298,14 @@ async def retry_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
+    # last message is removed from the context
+    last_dialog_message = await db.pop_last_dialog_message(user_id, dialog_id=None)
+    if last_dialog_message is None:
         await update.message.reply_text("No message to retry 🤷‍♂️")
         return
 
-    last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(
-        user_id, dialog_messages, dialog_id=None
-    )  # last message was removed from the context
-
     await message_handle(
         update,
         context,
@@ -325,28 +337,31 @@ async def message_handle(
         return
 
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
 
     # if chat_mode == "artist":
     #     await generate_image_handle(update, context, message=message)
     #     return
 
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = await db.get_user_attribute(user_id, "current_model")
 
     async def message_handle_fn():
         # new dialog timeout
         if use_new_dialog_timeout:
             if (
-                datetime.now() - db.get_user_attribute(user_id, "last_interaction")
+                datetime.now()
+                - await db.get_user_attribute(user_id, "last_interaction")
             ).seconds > config.new_dialog_timeout and len(
-                db.get_dialog_messages(user_id)
+                await db.get_dialog_messages(user_id, last_n=1)
             ) > 0:
-                db.start_new_dialog(user_id)
+                await db.start_new_dialog(user_id)
                 await update.message.reply_text(
                     f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅",
                     parse_mode=ParseMode.HTML,
                 )
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        await db.set_user_attribute_deferred(
+            user_id, "last_interaction", datetime.now()
+        )
 
         # in case of CancelledError
         n_input_tokens, n_output_tokens = 0, 0
@@ -365,12 +380,17 @@ async def message_handle(
                 )
                 return
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+            # only the tail that can fit the model context is read; the token
+            # budget in ChatGPT decides what is actually dropped
+            chatgpt_instance = openai_utils.get_chatgpt(current_model)
+            dialog_messages, n_dialog_messages = await db.get_dialog_tail(
+                user_id, chatgpt_instance.max_dialog_messages(), dialog_id=None
+            )
+            n_dialog_messages_not_read = n_dialog_messages - len(dialog_messages)
             parse_mode = {"html": ParseMode.HTML, "markdown": ParseMode.MARKDOWN}[
                 config.chat_modes[chat_mode]["parse_mode"]
             ]
 
-            chatgpt_instance = openai_utils.ChatGPT(model=current_model)
             if config.enable_message_streaming:
                 gen = chatgpt_instance.send_message_stream(
                     _message, dialog_messages=dialog_messages, chat_mode=chat_mode
@@ -392,42 +412,29 @@ async def message_handle(
 
                 gen = fake_gen()
 
-            prev_answer = ""
-
-            async for gen_item in gen:
-                (
-                    status,
-                    answer,
-                    (n_input_tokens, n_output_tokens),
-                    n_first_dialog_messages_removed,
-                ) = gen_item
-
-                answer = answer[:4096]  # telegram message limit
+            # placeholder is edited on a time-based cadence shared by all chats
+            async with edit_scheduler.stream(
+                context.bot,
+                placeholder_message.chat_id,
+                placeholder_message.message_id,
+                parse_mode=parse_mode,
+            ) as editor:
+                async for gen_item in gen:
+                    (
+                        status,
+                        answer,
+                        (n_input_tokens, n_output_tokens),
+                        n_first_dialog_messages_removed,
+                    ) = gen_item
 
-                # update only when 100 new symbols are ready
-                if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                    continue
+                    answer = answer[:4096]  # telegram message limit
 
-                try:
-                    await context.bot.edit_message_text(
-                        answer,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id,
-                        parse_mode=parse_mode,
-                    )
-                except telegram.error.BadRequest as e:
-                    if str(e).startswith("Message is not modified"):
-                        continue
+                    if status == "finished":
+                        await editor.finish(answer)
                     else:
-                        await context.bot.edit_message_text(
-                            answer,
-                            chat_id=placeholder_message.chat_id,
-                            message_id=placeholder_message.message_id,
-                        )
+                        await editor.update(answer)
 
-                await asyncio.sleep(0.01)  # wait a bit to avoid flooding
-
-                prev_answer = answer
+            n_first_dialog_messages_removed += n_dialog_messages_not_read
 
             # update user data
             new_dialog_message = {
@@ -436,19 +443,16 @@ async def message_handle(
                 "date": datetime.now(),
             }
 
-            db.set_dialog_messages(
-                user_id,
-                db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                dialog_id=None,
-            )
+            new_dialog_message = with_token_count(new_dialog_message, current_model)
+            await db.append_dialog_message(user_id, new_dialog_message, dialog_id=None)
 
-            db.update_n_used_tokens(
+            await db.update_n_used_tokens(
                 user_id, current_model, n_input_tokens, n_output_tokens
             )
 
         except asyncio.CancelledError:
             # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-            db.update_n_used_tokens(
+            await db.update_n_used_tokens(
                 user_id, current_model, n_input_tokens, n_output_tokens
             )
             raise
@@ -501,13 +505,13 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.set_user_attribute(user_id, "current_model", "gpt-4o-mini")
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "current_model", "gpt-4o-mini")
 
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
     await update.message.reply_text("Starting new dialog ✅")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
     await update.message.reply_text(
         f"{config.chat_modes[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML
     )
@@ -517,7 +521,7 @@ async def cancel_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
 
     if user_id in user_tasks:
         task = user_tasks[user_id]
@@ -539,8 +543,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
     chat_mode = query.data.split("|")[1]
 
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id)
 
     await context.bot.send_message(
         update.callback_query.message.chat.id,
@@ -560,20 +564,17 @@ async def set_strategy_handle(update: Update, context: CallbackContext):
 
     strategy = query.data.split("|")[1]
 
-    if strategy == "day_trading":
-        list_traders = db.get_day_trading()
-    elif strategy == "scalping":
-        list_traders = db.get_scalping()
+    list_traders = await strategy_refresher.get_leaderboard(strategy)
     html_links = [
         f'<a href="https://app.copin.io/trader/{doc["account"]}">{doc["account"]}</a>'
         for doc in list_traders
     ]
 
-    reply_text = "Here is top 10 traders in this strategy: 🤖\n\n"
+    reply_text = f"Here is top {config.strategy_top_n} traders in this strategy: 🤖\n\n"
     for trader in html_links:
         reply_text += f"Account: {trader}\n\n"
     reply_text = reply_text[:4096]  # telegram message limit
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
     await context.bot.send_message(
         update.callback_query.message.chat.id,
         reply_text,
@@ -590,8 +591,8 @@ async def set_strategy_handle(update: Update, context: CallbackContext):
     # )
 
 
-def get_settings_menu(user_id: int):
-    current_model = db.get_user_attribute(user_id, "current_model")
+async def get_settings_menu(user_id: int):
+    current_model = await db.get_user_attribute(user_id, "current_model")
     text = config.models["info"][current_model]["description"]
 
     text += "\n\n"
@@ -622,9 +623,9 @@ async def settings_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute_deferred(user_id, "last_interaction", datetime.now())
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     await update.message.reply_text(
         text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
     )
@@ -640,10 +641,10 @@ async def set_settings_handle(update: Update, context: CallbackContext):
     await query.answer()
 
     _, model_key = query.data.split("|")
-    db.set_user_attribute(user_id, "current_model", model_key)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "current_model", model_key)
+    await db.start_new_dialog(user_id)
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     try:
         await query.edit_message_text(
             text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
@@ -690,6 +691,16 @@ async def post_init(application: Application):
             BotCommand("/help", "Show help message"),
         ]
     )
+    await openai_utils.openai_client.start()
+    await asyncio.get_running_loop().run_in_executor(None, sync_db.log_query_plans)
+    strategy_refresher.start()
+    db.start_write_behind()
+
+
+async def post_shutdown(application: Application):
+    await strategy_refresher.stop()
+    await db.close()
+    await openai_utils.openai_client.close()
 
 
 def run_bot() -> None:
@@ -701,6 +712,7 @@ def run_bot() -> None:
         .http_version("1.1")
         .get_updates_http_version("1.1")
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -0,0 +1,259 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import config
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+PRICE_COLUMNS = ["open_price", "close_price", "high_price", "low_price"]
+# thứ tự các hàng trong file .npy: hàng 0 là timestamp, các hàng sau là giá
+STORE_COLUMNS = ["timestamp"] + PRICE_COLUMNS
+# số nến tối đa sàn trả về trong một request
+FETCH_LIMIT = 1000
+# số nến của mỗi file chunk, chunk thứ i chứa nến có timestamp trong
+# [i * CHUNK_BARS * interval_ms, (i + 1) * CHUNK_BARS * interval_ms)
+CHUNK_BARS = 10000
+
+
+class CandleStore:
+    """Kho nến OHLC trên đĩa, mỗi (exchange, symbol, interval) là một thư mục
+
+    Nến được chia thành các file chunk .npy cố định CHUNK_BARS nến, mỗi file là
+    mảng float64 dạng cột (5, n) được đọc bằng memory map, kèm file ranges.json
+    ghi lại những khoảng thời gian đã có đủ nến. Khi thiếu nến chỉ các chunk
+    chứa nến mới được ghi lại, nên chi phí không tăng theo lượng dữ liệu đã
+    lưu. Chỉ nến đã đóng mới được lưu nên dữ liệu trong kho không bao giờ phải
+    tải lại.
+    """
+
+    def __init__(self, root_dir=None):
+        self.root_dir = Path(root_dir or config.candle_store_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _key_dir(self, exchange, symbol, interval):
+        return self.root_dir / exchange / symbol / interval
+
+    def _thread_lock(self, key_dir):
+        with self._locks_guard:
+            if key_dir not in self._locks:
+                self._locks[key_dir] = threading.Lock()
+            return self._locks[key_dir]
+
+    @contextmanager
+    def _lock(self, key_dir):
+        """Khoá theo key giữa các thread và giữa các process dùng chung kho"""
+        with self._thread_lock(key_dir):
+            if fcntl is None:
+                yield
+                return
+            with open(key_dir / ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_ranges(self, key_dir):
+        try:
+            with open(key_dir / "ranges.json", "r") as f:
+                return [tuple(r) for r in json.load(f)]
+        except FileNotFoundError:
+            return []
+
+    def _write_ranges(self, key_dir, ranges):
+        tmp_path = key_dir / "ranges.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(ranges, f)
+        os.replace(tmp_path, key_dir / "ranges.json")
+
+    def _read_chunk(self, key_dir, chunk_id):
+        try:
+            return np.load(key_dir / f"chunk-{chunk_id}.npy", mmap_mode="r")
+        except FileNotFoundError:
+            return np.empty((len(STORE_COLUMNS), 0), dtype=np.float64)
+
+    def _write_chunks(self, key_dir, candles, chunk_ms):
+        """Gộp nến mới vào các chunk chứa chúng, chỉ ghi lại những chunk đó"""
+        chunk_ids = candles[0] // chunk_ms
+        for chunk_id in np.unique(chunk_ids):
+            chunk_id = int(chunk_id)
+            chunk = _merge_candles(
+                [self._read_chunk(key_dir, chunk_id), candles[:, chunk_ids == chunk_id]]
+            )
+            tmp_path = key_dir / f"chunk-{chunk_id}.npy.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, chunk)
+            os.replace(tmp_path, key_dir / f"chunk-{chunk_id}.npy")
+
+    def _read_window(self, key_dir, chunk_ms, start, end):
+        parts = []
+        for chunk_id in range(start // chunk_ms, end // chunk_ms + 1):
+            chunk = self._read_chunk(key_dir, chunk_id)
+            lo = np.searchsorted(chunk[0], start, side="left")
+            hi = np.searchsorted(chunk[0], end, side="right")
+            parts.append(np.array(chunk[:, lo:hi]))
+        return np.concatenate(parts, axis=1)
+
+    def _migrate_single_file(self, key_dir, chunk_ms):
+        """Chia file candles.npy của bản cũ thành các chunk"""
+        path = key_dir / "candles.npy"
+        if path.exists():
+            self._write_chunks(key_dir, np.load(path), chunk_ms)
+            path.unlink()
+
+    def get_candles(
+        self, exchange, symbol, interval, interval_seconds, start, end, fetch
+    ):
+        """Trả về DataFrame nến trong [start, end] (ms), chỉ tải những khoảng còn thiếu
+
+        `fetch(symbol, interval, start, end)` là hàm tải nến từ sàn, trả về mảng
+        (5, n) hoặc DataFrame, ví dụ fetch_klines_BINGX. Việc tải chạy ngoài
+        khoá nên các cửa sổ khác của cùng key không phải chờ.
+        """
+        interval_ms = interval_seconds * 1000
+        chunk_ms = CHUNK_BARS * interval_ms
+        # nến cuối cùng đã đóng tính đến thời điểm hiện tại
+        last_closed = (int(time.time() * 1000) // interval_ms - 1) * interval_ms
+        stored_end = min(end, last_closed)
+
+        key_dir = self._key_dir(exchange, symbol, interval)
+        key_dir.mkdir(parents=True, exist_ok=True)
+
+        with self._lock(key_dir):
+            self._migrate_single_file(key_dir, chunk_ms)
+            ranges = self._read_ranges(key_dir)
+        gaps = _find_gaps(ranges, start, stored_end) if start <= stored_end else []
+
+        if gaps:
+            self.n_misses += 1
+            new_parts, new_ranges = [], []
+            for gap in gaps:
+                parts, covered = _fetch_gap(fetch, symbol, interval, interval_ms, *gap)
+                new_parts.extend(parts)
+                new_ranges.extend(covered)
+
+            with self._lock(key_dir):
+                # ghi nến trước rồi mới ghi ranges, để ranges không bao giờ
+                # chứa khoảng thời gian mà chunk chưa có
+                self._write_chunks(key_dir, _merge_candles(new_parts), chunk_ms)
+                ranges = _merge_ranges(self._read_ranges(key_dir) + new_ranges)
+                self._write_ranges(key_dir, ranges)
+        else:
+            self.n_hits += 1
+
+        if start <= stored_end:
+            with self._lock(key_dir):
+                result = self._read_window(key_dir, chunk_ms, start, stored_end)
+        else:
+            result = np.empty((len(STORE_COLUMNS), 0), dtype=np.float64)
+
+        if end > stored_end:
+            # phần nến chưa đóng không được lưu, luôn tải trực tiếp
+            live = _to_array(fetch(symbol, interval, max(start, stored_end + 1), end))
+            result = _merge_candles([result, live])
+
+        return candles_to_frame(result)
+
+
+def _fetch_gap(fetch, symbol, interval, interval_ms, gap_start, gap_end):
+    """Tải đủ nến của một khoảng trống, chia nhỏ khi bị cắt bởi FETCH_LIMIT
+
+    Trả về (các mảng nến, các khoảng đã có đủ nến). Lỗi của fetch được ném
+    ra nên khoảng tải thất bại không bao giờ được ghi vào ranges.
+    """
+    parts, covered = [], []
+    sub_gaps = [(gap_start, gap_end)]
+    while sub_gaps:
+        sub_start, sub_end = sub_gaps.pop()
+        part = _to_array(fetch(symbol, interval, sub_start, sub_end))
+        parts.append(part)
+        if part.shape[1] < FETCH_LIMIT:
+            covered.append((sub_start, sub_end))
+            continue
+        # bị cắt bởi limit của API: ghi nhận phần đã nhận, tải tiếp phần còn
+        # thiếu ở hai đầu (tuỳ sàn trả nến đầu hay nến cuối của khoảng)
+        part_start = max(sub_start, int(part[0].min()))
+        part_end = min(sub_end, int(part[0].max()))
+        if part_start - interval_ms >= sub_start:
+            sub_gaps.append((sub_start, part_start - 1))
+        else:
+            part_start = sub_start
+        if part_end + interval_ms <= sub_end:
+            sub_gaps.append((part_end + 1, sub_end))
+        else:
+            part_end = sub_end
+        covered.append((part_start, part_end))
+    return parts, covered
+
+
+def _find_gaps(ranges, start, end):
+    """Những khoảng con của [start, end] chưa nằm trong ranges"""
+    gaps = []
+    cursor = start
+    for range_start, range_end in sorted(ranges):
+        if range_end < cursor:
+            continue
+        if range_start > end:
+            break
+        if range_start > cursor:
+            gaps.append((cursor, range_start - 1))
+        cursor = max(cursor, range_end + 1)
+        if cursor > end:
+            break
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for range_start, range_end in sorted(ranges):
+        if merged and range_start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def _merge_candles(parts):
+    """Gộp các mảng nến, sắp xếp và bỏ trùng theo timestamp"""
+    candles = np.concatenate([np.asarray(part) for part in parts], axis=1)
+    _, unique_index = np.unique(candles[0], return_index=True)
+    return candles[:, unique_index]
+
+
+def candles_to_frame(candles):
+    """DataFrame nến từ mảng (5, n), timestamp int64 và giá float64"""
+    return pd.DataFrame(
+        {
+            "timestamp": candles[0].astype(np.int64),
+            **{column: candles[i + 1] for i, column in enumerate(PRICE_COLUMNS)},
+        }
+    )
+
+
+def _to_array(price_crypto):
+    """Chuyển nến trả về từ sàn (mảng (5, n) hoặc DataFrame) thành mảng float64"""
+    if isinstance(price_crypto, np.ndarray):
+        return price_crypto
+    return np.vstack(
+        [
+            pd.to_numeric(price_crypto[column], errors="coerce").to_numpy(np.float64)
+            for column in STORE_COLUMNS
+        ]
+    )
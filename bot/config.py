@@ -14,16 +14,64 @@ with open(config_dir / "config.yml", "r") as f:
 openai_api_key = config_yaml["openai_api_key"]
 telegram_token = config_yaml["telegram_token"]
 mongodb_uri = f"mongodb://localhost:{config_env['MONGODB_PORT']}"
+mongodb_max_pool_size = config_yaml.get("mongodb_max_pool_size", 100)
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
+# message edit interval while streaming (seconds), backs off on Telegram flood limits
+stream_edit_interval = config_yaml.get("stream_edit_interval", 1.0)
+stream_edit_group_interval = config_yaml.get("stream_edit_group_interval", 3.0)
+stream_edit_max_interval = config_yaml.get("stream_edit_max_interval", 10.0)
+stream_global_edits_per_second = config_yaml.get("stream_global_edits_per_second", 25)
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 image_size = config_yaml.get("image_size", "512x512")
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 
 bingx_api_url = config_yaml["bingx_api_url"]
+bitget_api_url = config_yaml.get(
+    "bitget_api_url", "https://api.bitget.com/api/v2/mix/market/candles"
+)
 dev_graphql_api = config_yaml["dev_graphql_api"]
 n_strategy_per_page = config_yaml.get("n_strategy_per_page", 5)
+candle_fetch_concurrency = config_yaml.get("candle_fetch_concurrency", 8)
+candle_merge_gap_bars = config_yaml.get("candle_merge_gap_bars", 60)
+candle_refine_extremes = config_yaml.get("candle_refine_extremes", True)
+candle_store_dir = config_yaml.get(
+    "candle_store_dir", str(config_dir.parent / "data" / "candles")
+)
+
+# http client
+http_timeouts = config_yaml.get("http_timeouts", {})
+http_pool_size = config_yaml.get("http_pool_size", 16)
+http_max_retries = config_yaml.get("http_max_retries", 3)
+http_backoff = config_yaml.get("http_backoff", 0.25)
+http_max_backoff = config_yaml.get("http_max_backoff", 4.0)
+http_keepalive_timeout = config_yaml.get("http_keepalive_timeout", 30)
+openai_pool_size = config_yaml.get("openai_pool_size", 32)
+
+# GraphQL query batching
+graphql_batch_window = config_yaml.get("graphql_batch_window", 0.02)
+graphql_batch_max_size = config_yaml.get("graphql_batch_max_size", 20)
+copin_page_size = config_yaml.get("copin_page_size", 500)
+
+# GraphQL result cache, ttl in seconds keyed by the query's root field name
+graphql_cache_max_size = config_yaml.get("graphql_cache_max_size", 1024)
+graphql_cache_ttl = {
+    "searchTopOpeningPosition": 60,
+    "searchPositionStatistic": 300,
+    "default": 60,
+    **config_yaml.get("graphql_cache_ttl", {}),
+}
+graphql_cache_mongo = config_yaml.get("graphql_cache_mongo", False)
+
+# background strategy leaderboard refresh, in seconds
+strategy_refresh_interval = config_yaml.get("strategy_refresh_interval", 300)
+strategy_top_n = config_yaml.get("strategy_top_n", 10)
+
+# in-process user document cache, entries idle for longer than this are dropped
+user_cache_idle_timeout = config_yaml.get("user_cache_idle_timeout", 600)
+# coalesced last_interaction writes are flushed to Mongo every this many seconds
+user_write_flush_interval = config_yaml.get("user_write_flush_interval", 5)
 
 
 # chat_modes
@@ -1,11 +1,105 @@
 from typing import Optional, Any
 
+import asyncio
+import copy
+import logging
+import motor.motor_asyncio
 import pymongo
+import time
 import uuid
 from datetime import datetime
 
 import config
-from analyze_func import query_strategy_day_trading, query_strategy_scalping
+from analyze_func import query_strategy
+from user_cache import UserCache
+
+logger = logging.getLogger(__name__)
+
+
+# indexes of each collection, created (idempotently) when Database starts
+STRATEGY_INDEXES = [
+    pymongo.IndexModel(
+        [("account", pymongo.ASCENDING), ("protocol", pymongo.ASCENDING)],
+        unique=True,
+    ),
+    # leaderboard: sorted by realisedPnl and projected to account, covered by the index
+    pymongo.IndexModel(
+        [("realisedPnl", pymongo.DESCENDING), ("account", pymongo.ASCENDING)],
+    ),
+]
+INDEXES = {
+    "user": [
+        pymongo.IndexModel([("last_interaction", pymongo.DESCENDING)]),
+    ],
+    "dialog": [
+        pymongo.IndexModel(
+            [("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)],
+        ),
+    ],
+    "day_trading": STRATEGY_INDEXES,
+    "scalping": STRATEGY_INDEXES,
+    # usage buckets per user/day/model, _id is already user_id:day:model
+    "usage": [
+        pymongo.IndexModel([("day", pymongo.ASCENDING), ("model", pymongo.ASCENDING)]),
+    ],
+    "position_metrics": [
+        pymongo.IndexModel(
+            [
+                ("account", pymongo.ASCENDING),
+                ("exchange", pymongo.ASCENDING),
+                ("closeBlockTime", pymongo.DESCENDING),
+            ],
+        ),
+    ],
+}
+
+
+def token_usage_updates(
+    user_id: int, model: str, n_input_tokens: int, n_output_tokens: int
+):
+    """$inc updates for the user and the day's usage bucket of one model call
+
+    Returns (user update, bucket filter, bucket update).
+    """
+    # Mongo field names cannot contain "."
+    model_key = model.replace(".", "_")
+    user_update = {
+        "$inc": {
+            f"n_used_tokens.{model_key}.n_input_tokens": n_input_tokens,
+            f"n_used_tokens.{model_key}.n_output_tokens": n_output_tokens,
+        }
+    }
+
+    day = datetime.now().strftime("%Y-%m-%d")
+    bucket_filter = {"_id": f"{user_id}:{day}:{model}"}
+    bucket_update = {
+        "$inc": {
+            "n_input_tokens": n_input_tokens,
+            "n_output_tokens": n_output_tokens,
+            "n_requests": 1,
+        },
+        "$setOnInsert": {"user_id": user_id, "day": day, "model": model},
+    }
+    return user_update, bucket_filter, bucket_update
+
+
+def summarize_plan(explain):
+    """Summarize explain(): winning plan stages and keys/docs examined"""
+    stages = []
+    plan = explain["queryPlanner"]["winningPlan"]
+    while plan is not None:
+        stage = plan["stage"]
+        if "indexName" in plan:
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage")
+
+    stats = explain.get("executionStats", {})
+    return (
+        f"{' <- '.join(stages)}, keys examined: {stats.get('totalKeysExamined')}, "
+        f"docs examined: {stats.get('totalDocsExamined')}, "
+        f"returned: {stats.get('nReturned')}"
+    )
 
 
 class Database:
@@ -14,11 +108,29 @@ class Database:
         self.db = self.client["copin_telegram_bot"]
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
+        self.usage_collection = self.db["usage"]
+        self.user_cache = UserCache()
         self.day_trading_strategy = self.db["day_trading"]
         self.scalping_strategy = self.db["scalping"]
+        self.strategy_collections = {
+            "day_trading": self.day_trading_strategy,
+            "scalping": self.scalping_strategy,
+        }
+        self.graphql_cache_collection = self.db["graphql_cache"]
+        self.position_metrics = self.db["position_metrics"]
+        self.create_indexes()
+
+    def _get_user(self, user_id: int):
+        """User document from the cache, read from Mongo once on a miss"""
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is None:
+            user_dict = self.user_collection.find_one({"_id": user_id})
+            if user_dict is not None:
+                self.user_cache.set(user_id, user_dict)
+        return user_dict
 
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        if self._get_user(user_id) is not None:
             return True
         else:
             if raise_exception:
@@ -52,6 +164,7 @@ class Database:
 
         if not self.check_if_user_exists(user_id):
             self.user_collection.insert_one(user_dict)
+            self.user_cache.set(user_id, user_dict)
 
     def start_new_dialog(self, user_id: int):
         self.check_if_user_exists(user_id, raise_exception=True)
@@ -70,52 +183,141 @@ class Database:
         self.dialog_collection.insert_one(dialog_dict)
 
         # update user's current dialog
-        self.user_collection.update_one(
-            {"_id": user_id}, {"$set": {"current_dialog_id": dialog_id}}
-        )
+        self.set_user_attribute(user_id, "current_dialog_id", dialog_id)
 
         return dialog_id
 
     def get_user_attribute(self, user_id: int, key: str):
         self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+        user_dict = self._get_user(user_id)
 
         if key not in user_dict:
             return None
 
-        return user_dict[key]
+        # copy so that mutating the returned value does not touch the cache
+        return copy.deepcopy(user_dict[key])
 
     def set_user_attribute(self, user_id: int, key: str, value: Any):
         self.check_if_user_exists(user_id, raise_exception=True)
         self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        self.user_cache.update(user_id, {key: value})
 
     def update_n_used_tokens(
         self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int
     ):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+        self.check_if_user_exists(user_id, raise_exception=True)
+        user_update, bucket_filter, bucket_update = token_usage_updates(
+            user_id, model, n_input_tokens, n_output_tokens
+        )
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
-        else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens,
-            }
+        user_dict = self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            user_update,
+            projection={"n_used_tokens": 1},
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        self.user_cache.update(user_id, {"n_used_tokens": user_dict["n_used_tokens"]})
+        self.usage_collection.update_one(bucket_filter, bucket_update, upsert=True)
+
+    def get_usage_report(
+        self, start_day: str, end_day: str, user_id: Optional[int] = None
+    ):
+        """Total tokens and cost per model within [start_day, end_day] (YYYY-MM-DD)"""
+        match = {"day": {"$gte": start_day, "$lte": end_day}}
+        if user_id is not None:
+            match["user_id"] = user_id
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+        report = {}
+        for row in self.usage_collection.aggregate(
+            [
+                {"$match": match},
+                {
+                    "$group": {
+                        "_id": "$model",
+                        "n_input_tokens": {"$sum": "$n_input_tokens"},
+                        "n_output_tokens": {"$sum": "$n_output_tokens"},
+                        "n_requests": {"$sum": "$n_requests"},
+                    }
+                },
+            ]
+        ):
+            model = row.pop("_id")
+            info = config.models["info"].get(model, {})
+            row["cost"] = (
+                row["n_input_tokens"] * info.get("price_per_1000_input_tokens", 0)
+                + row["n_output_tokens"] * info.get("price_per_1000_output_tokens", 0)
+            ) / 1000
+            report[model] = row
+        return report
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
+    def get_dialog_messages(
+        self,
+        user_id: int,
+        dialog_id: Optional[str] = None,
+        last_n: Optional[int] = None,
+    ):
         self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
             dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
 
+        # last_n: read only the last n messages, not the whole dialog
+        projection = {"messages": 1 if last_n is None else {"$slice": -last_n}}
         dialog_dict = self.dialog_collection.find_one(
-            {"_id": dialog_id, "user_id": user_id}
+            {"_id": dialog_id, "user_id": user_id}, projection
         )
         return dialog_dict["messages"]
 
+    def get_dialog_tail(
+        self, user_id: int, last_n: int, dialog_id: Optional[str] = None
+    ):
+        """(last last_n messages, total message count of the dialog) in one read"""
+        self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        pipeline = [
+            {"$match": {"_id": dialog_id, "user_id": user_id}},
+            {
+                "$project": {
+                    "messages": {"$slice": ["$messages", -last_n]},
+                    "n_messages": {"$size": "$messages"},
+                }
+            },
+        ]
+        dialog_dicts = list(self.dialog_collection.aggregate(pipeline))
+        return dialog_dicts[0]["messages"], dialog_dicts[0]["n_messages"]
+
+    def append_dialog_message(
+        self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None
+    ):
+        self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": dialog_message}},
+        )
+
+    def pop_last_dialog_message(self, user_id: int, dialog_id: Optional[str] = None):
+        """Remove and return the last dialog message, None if the dialog is empty"""
+        self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id, "messages.0": {"$exists": True}},
+            {"$pop": {"messages": 1}},
+            projection={"messages": {"$slice": -1}},
+        )
+        if dialog_dict is None:
+            return None
+        return dialog_dict["messages"][-1]
+
     def set_dialog_messages(
         self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None
     ):
@@ -129,24 +331,399 @@ class Database:
             {"$set": {"messages": dialog_messages}},
         )
 
+    def create_indexes(self):
+        for name, indexes in INDEXES.items():
+            collection = self.db[name]
+            try:
+                collection.create_indexes(indexes)
+            except pymongo.errors.DuplicateKeyError:
+                if name not in self.strategy_collections:
+                    raise
+                # older versions inserted duplicates, drop documents without a snapshot
+                collection.delete_many({"snapshot": {"$exists": False}})
+                collection.create_indexes(indexes)
+            except pymongo.errors.OperationFailure as e:
+                # an index with the same keys but other name/options is left over
+                logger.warning(f"Could not create indexes for {name}: {e}")
+
+    def log_query_plans(self):
+        """Log an explain() summary of the frequently run queries"""
+        hot_queries = {
+            "user by _id": self.user_collection.find({"_id": 0}).limit(1),
+            "dialog messages": self.dialog_collection.find(
+                {"_id": "", "user_id": 0}, {"messages": 1}
+            ).limit(1),
+            "position metrics latest": self.position_metrics.find(
+                {"account": "", "exchange": ""}, {"_id": 0, "closeBlockTime": 1}
+            )
+            .sort("closeBlockTime", pymongo.DESCENDING)
+            .limit(1),
+        }
+        for strategy in self.strategy_collections:
+            hot_queries[f"{strategy} leaderboard"] = self._strategy_cursor(strategy)
+
+        for name, cursor in hot_queries.items():
+            try:
+                logger.info(f"Query plan {name}: {summarize_plan(cursor.explain())}")
+            except Exception as e:
+                logger.warning(f"Query plan {name} failed: {e}")
+
+    def _ingest_strategy(self, collection, df):
+        """Upsert the strategy table in one bulk_write, keyed by account + protocol
+
+        Each ingest stamps a new `snapshot`; traders missing from the new table are
+        deleted so the collection only holds the current snapshot.
+        """
+        if isinstance(df, str) or df.empty:
+            return None
+
+        snapshot = time.time_ns()
+        requests = []
+        for document in df.to_dict("records"):
+            document["snapshot"] = snapshot
+            requests.append(
+                pymongo.ReplaceOne(
+                    {"account": document["account"], "protocol": document["protocol"]},
+                    document,
+                    upsert=True,
+                )
+            )
+        collection.bulk_write(requests, ordered=False)
+        collection.delete_many({"snapshot": {"$ne": snapshot}})
+        return snapshot
+
+    def set_strategy(self, strategy: str):
+        df = query_strategy(strategy)
+        return self._ingest_strategy(self.strategy_collections[strategy], df)
+
+    def _strategy_cursor(self, strategy: str, limit: int = 10):
+        collection = self.strategy_collections[strategy]
+        return (
+            collection.find({}, {"_id": 0, "account": 1})
+            .sort([("realisedPnl", pymongo.DESCENDING), ("account", pymongo.ASCENDING)])
+            .limit(limit)
+        )
+
+    def get_strategy(self, strategy: str, limit: int = 10):
+        """Top traders by realisedPnl from the stored snapshot, copin is not queried"""
+        return list(self._strategy_cursor(strategy, limit))
+
     def set_day_trading(self):
-        df = query_strategy_day_trading()
-        for _, row in df.iterrows():
-            document = row.to_dict()  # Chuyển hàng DataFrame thành dictionary
-            self.day_trading_strategy.insert_one(document)
+        return self.set_strategy("day_trading")
 
     def get_day_trading(self):
-        self.set_day_trading()
-        result = self.day_trading_strategy.find({}, {"_id": 0, "account": 1}).limit(10)
-        return result
+        return self.get_strategy("day_trading")
 
     def set_scalping(self):
-        df = query_strategy_scalping()
-        for _, row in df.iterrows():
-            document = row.to_dict()  # Chuyển hàng DataFrame thành dictionary
-            self.scalping_strategy.insert_one(document)
+        return self.set_strategy("scalping")
 
     def get_scalping(self):
-        self.set_scalping()
-        result = self.scalping_strategy.find({}, {"_id": 0, "account": 1}).limit(10)
-        return result
+        return self.get_strategy("scalping")
+
+    def get_latest_position_close_time(self, account: str, exchange: str):
+        """closeBlockTime (ms) of the latest stored position, None if there is none"""
+        document = self.position_metrics.find_one(
+            {"account": account, "exchange": exchange},
+            {"_id": 0, "closeBlockTime": 1},
+            sort=[("closeBlockTime", pymongo.DESCENDING)],
+        )
+        if document is None:
+            return None
+        return document["closeBlockTime"]
+
+    def upsert_position_metrics(self, account: str, exchange: str, positions: list):
+        # closed positions never change, so pair + open/close time identify them
+        requests = []
+        for position in positions:
+            position_id = (
+                f"{account}:{exchange}:{position['pair']}:"
+                f"{position['openBlockTime']}:{position['closeBlockTime']}:"
+                f"{position['isLong']}"
+            )
+            document = {**position, "account": account, "exchange": exchange}
+            requests.append(
+                pymongo.ReplaceOne({"_id": position_id}, document, upsert=True)
+            )
+        if requests:
+            self.position_metrics.bulk_write(requests, ordered=False)
+
+    def get_position_metrics(self, account: str, exchange: str, limit: int = 20):
+        result = (
+            self.position_metrics.find(
+                {"account": account, "exchange": exchange},
+                {"_id": 0, "account": 0, "exchange": 0},
+            )
+            .sort("closeBlockTime", pymongo.DESCENDING)
+            .limit(limit)
+        )
+        return list(result)
+
+
+class AsyncDatabase:
+    """Async counterpart of Database for the bot handlers, backed by motor
+
+    Same method names as Database, but awaitable. Index creation, strategy
+    ingest and position metrics stay on Database (pymongo).
+    """
+
+    def __init__(self):
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(
+            config.mongodb_uri, maxPoolSize=config.mongodb_max_pool_size
+        )
+        self.db = self.client["copin_telegram_bot"]
+        self.user_collection = self.db["user"]
+        self.dialog_collection = self.db["dialog"]
+        self.usage_collection = self.db["usage"]
+        self.user_cache = UserCache()
+        # user_id -> {field: value} waiting to be written to Mongo
+        self._pending_writes = {}
+        # fields being flushed, still newer than the values in Mongo
+        self._flushing_writes = {}
+        self._flush_task = None
+        self._stop_flush = None
+
+    async def _get_user(self, user_id: int):
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is None:
+            user_dict = await self.user_collection.find_one({"_id": user_id})
+            if user_dict is not None:
+                # unflushed values are newer than the ones in Mongo
+                user_dict.update(self._flushing_writes.get(user_id, {}))
+                user_dict.update(self._pending_writes.get(user_id, {}))
+                self.user_cache.set(user_id, user_dict)
+        return user_dict
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        if await self._get_user(user_id) is not None:
+            return True
+        else:
+            if raise_exception:
+                raise ValueError(f"User {user_id} does not exist")
+            else:
+                return False
+
+    async def add_new_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ):
+        user_dict = {
+            "_id": user_id,
+            "chat_id": chat_id,
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "last_interaction": datetime.now(),
+            "first_seen": datetime.now(),
+            "current_dialog_id": None,
+            "n_used_tokens": {},
+        }
+
+        if not await self.check_if_user_exists(user_id):
+            await self.user_collection.insert_one(user_dict)
+            self.user_cache.set(user_id, user_dict)
+
+    async def start_new_dialog(self, user_id: int):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        dialog_id = str(uuid.uuid4())
+        dialog_dict = {
+            "_id": dialog_id,
+            "user_id": user_id,
+            "chat_mode": await self.get_user_attribute(user_id, "current_chat_mode"),
+            "start_time": datetime.now(),
+            "model": await self.get_user_attribute(user_id, "current_model"),
+            "messages": [],
+        }
+
+        # add new dialog
+        await self.dialog_collection.insert_one(dialog_dict)
+
+        # update user's current dialog
+        await self.set_user_attribute(user_id, "current_dialog_id", dialog_id)
+
+        return dialog_id
+
+    async def get_user_attribute(self, user_id: int, key: str):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        user_dict = await self._get_user(user_id)
+
+        if key not in user_dict:
+            return None
+
+        return copy.deepcopy(user_dict[key])
+
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        # a direct write drops the pending value so the flush doesn't overwrite it
+        self._pending_writes.get(user_id, {}).pop(key, None)
+        await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        self.user_cache.update(user_id, {key: value})
+
+    async def set_user_attribute_deferred(self, user_id: int, key: str, value: Any):
+        """Like set_user_attribute, but written to Mongo on the next flush
+
+        The cache is updated right away, so reads in this process (e.g. the
+        new_dialog_timeout check) see the new value; repeated writes to a field
+        within one flush interval become a single update.
+        """
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        self._pending_writes.setdefault(user_id, {})[key] = value
+        self.user_cache.update(user_id, {key: value})
+
+    async def flush_user_writes(self):
+        pending, self._pending_writes = self._pending_writes, {}
+        self._flushing_writes = pending
+        requests = [
+            pymongo.UpdateOne({"_id": user_id}, {"$set": fields})
+            for user_id, fields in pending.items()
+            if fields
+        ]
+        try:
+            if requests:
+                await self.user_collection.bulk_write(requests, ordered=False)
+        except BaseException:
+            # requeue for the next flush, also when cancelled mid-write, unless
+            # the field got a newer value in the meantime
+            for user_id, fields in pending.items():
+                newer = self._pending_writes.setdefault(user_id, {})
+                for key, value in fields.items():
+                    newer.setdefault(key, value)
+            raise
+        finally:
+            self._flushing_writes = {}
+
+    async def _run_write_behind(self):
+        while not self._stop_flush.is_set():
+            try:
+                await asyncio.wait_for(
+                    self._stop_flush.wait(), config.user_write_flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush_user_writes()
+            except Exception as e:
+                logger.warning(f"Flushing user writes failed: {e}")
+
+    def start_write_behind(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._stop_flush = asyncio.Event()
+            self._flush_task = asyncio.get_running_loop().create_task(
+                self._run_write_behind()
+            )
+
+    async def update_n_used_tokens(
+        self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int
+    ):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        user_update, bucket_filter, bucket_update = token_usage_updates(
+            user_id, model, n_input_tokens, n_output_tokens
+        )
+
+        user_dict = await self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            user_update,
+            projection={"n_used_tokens": 1},
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        self.user_cache.update(user_id, {"n_used_tokens": user_dict["n_used_tokens"]})
+        await self.usage_collection.update_one(
+            bucket_filter, bucket_update, upsert=True
+        )
+
+    async def get_dialog_messages(
+        self,
+        user_id: int,
+        dialog_id: Optional[str] = None,
+        last_n: Optional[int] = None,
+    ):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        # last_n: read only the last n messages, not the whole dialog
+        projection = {"messages": 1 if last_n is None else {"$slice": -last_n}}
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id}, projection
+        )
+        return dialog_dict["messages"]
+
+    async def get_dialog_tail(
+        self, user_id: int, last_n: int, dialog_id: Optional[str] = None
+    ):
+        """(last last_n messages, total message count of the dialog) in one read"""
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        pipeline = [
+            {"$match": {"_id": dialog_id, "user_id": user_id}},
+            {
+                "$project": {
+                    "messages": {"$slice": ["$messages", -last_n]},
+                    "n_messages": {"$size": "$messages"},
+                }
+            },
+        ]
+        dialog_dicts = await self.dialog_collection.aggregate(pipeline).to_list(1)
+        return dialog_dicts[0]["messages"], dialog_dicts[0]["n_messages"]
+
+    async def append_dialog_message(
+        self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None
+    ):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": dialog_message}},
+        )
+
+    async def pop_last_dialog_message(
+        self, user_id: int, dialog_id: Optional[str] = None
+    ):
+        """Remove and return the last dialog message, None if the dialog is empty"""
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = await self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id, "messages.0": {"$exists": True}},
+            {"$pop": {"messages": 1}},
+            projection={"messages": {"$slice": -1}},
+        )
+        if dialog_dict is None:
+            return None
+        return dialog_dict["messages"][-1]
+
+    async def set_dialog_messages(
+        self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None
+    ):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {"messages": dialog_messages}},
+        )
+
+    async def close(self):
+        if self._flush_task is not None:
+            # let a flush that is already running finish instead of cancelling
+            # it, otherwise the batch it swapped out would be lost
+            self._stop_flush.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush_user_writes()
+        self.client.close()
@@ -0,0 +1,117 @@
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body):
+    """Parse JSON từ bytes/str, dùng orjson nếu đã cài"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+# thứ tự hàng của mảng nến, giống candle_store.STORE_COLUMNS
+CANDLE_COLUMNS = ["timestamp", "open_price", "close_price", "high_price", "low_price"]
+
+# schema cố định: tên cột -> (khoá trong JSON, dtype)
+BINGX_KLINE_SCHEMA = {
+    "timestamp": ("time", np.float64),
+    "open_price": ("open", np.float64),
+    "close_price": ("close", np.float64),
+    "high_price": ("high", np.float64),
+    "low_price": ("low", np.float64),
+}
+# bitget trả mỗi nến là list [ts, open, high, low, close, volume, quote_volume]
+BITGET_KLINE_SCHEMA = {
+    "timestamp": (0, np.float64),
+    "open_price": (1, np.float64),
+    "close_price": (4, np.float64),
+    "high_price": (2, np.float64),
+    "low_price": (3, np.float64),
+}
+STRATEGY_SCHEMA = {
+    "account": ("account", object),
+    "protocol": ("protocol", object),
+    "avgDuration": ("avgDuration", np.float64),
+    "totalTrade": ("totalTrade", np.float64),
+    "realisedPnl": ("realisedPnl", np.float64),
+    "realisedAvgRoi": ("realisedAvgRoi", np.float64),
+}
+# vị thế của searchTopOpeningPosition, thời gian được parse riêng sang int64 ms
+POSITION_SCHEMA = {
+    "openBlockTime": ("openBlockTime", object),
+    "closeBlockTime": ("closeBlockTime", object),
+    "pair": ("pair", object),
+    "durationInSecond": ("durationInSecond", np.float64),
+    "leverage": ("leverage", np.float64),
+    "isWin": ("isWin", bool),
+    "isLong": ("isLong", bool),
+    "realisedRoi": ("realisedRoi", np.float64),
+    "collateral": ("collateral", np.float64),
+    "size": ("size", np.float64),
+    "realisedPnl": ("realisedPnl", np.float64),
+}
+
+
+def decode_records(records, schema):
+    """Chuyển list record JSON thành dict {cột: np.ndarray} theo schema
+
+    Giá trị số dạng chuỗi (như giá của BingX) được numpy parse trực tiếp sang
+    float64, giá trị thiếu thành NaN.
+    """
+    columns = {}
+    for column, (key, dtype) in schema.items():
+        values = [record[key] for record in records]
+        if dtype is object:
+            columns[column] = np.array(values, dtype=object)
+            continue
+        try:
+            columns[column] = np.array(values, dtype=dtype)
+        except (TypeError, ValueError):
+            # có phần tử None hoặc không parse được
+            columns[column] = np.array(
+                [_to_float(value) for value in values], dtype=dtype
+            )
+    return columns
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def decode_klines(records, schema):
+    """Mảng nến float64 (5, n) theo CANDLE_COLUMNS, sắp xếp tăng dần theo thời gian"""
+    columns = decode_records(records, schema)
+    candles = np.vstack([columns[column] for column in CANDLE_COLUMNS])
+    if candles.shape[1] > 1 and candles[0, 0] > candles[0, -1]:
+        candles = candles[:, ::-1]
+    return np.ascontiguousarray(candles)
+
+
+class KlineAPIError(Exception):
+    """Sàn trả lỗi trong body dù HTTP 200, ví dụ bị giới hạn tần suất"""
+
+
+def _kline_data(body, ok_code, exchange):
+    response = loads(body)
+    if response.get("code") != ok_code:
+        raise KlineAPIError(
+            f"{exchange} kline error {response.get('code')}: {response.get('msg')}"
+        )
+    return response["data"]
+
+
+def decode_bingx_klines(body):
+    return decode_klines(_kline_data(body, 0, "BingX"), BINGX_KLINE_SCHEMA)
+
+
+def decode_bitget_klines(body):
+    return decode_klines(_kline_data(body, "00000", "Bitget"), BITGET_KLINE_SCHEMA)
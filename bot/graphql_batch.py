@@ -0,0 +1,106 @@
+import threading
+from concurrent.futures import Future
+
+import config
+
+
+class GraphQLBatcher:
+    """Gộp nhiều truy vấn GraphQL gửi gần nhau thành một request dùng alias
+
+    Mỗi lời gọi `submit(field)` với một field gốc, ví dụ
+    `searchPositionStatistic(...) { data { ... } }`, được giữ lại tối đa
+    `window` giây. Sau đó tất cả được gửi trong một document
+    `query { q0: ... q1: ... }` và kết quả được tách lại theo alias.
+
+    Khi không có batch nào đang gửi và chỉ có một field chờ, field đó được gửi
+    ngay, không phải chờ `window`; các field tới trong lúc một batch đang gửi
+    mới được gom lại.
+    """
+
+    def __init__(self, send, window=None, max_batch_size=None):
+        # send(query) -> dict JSON của response GraphQL
+        self.send = send
+        self.window = config.graphql_batch_window if window is None else window
+        self.max_batch_size = max_batch_size or config.graphql_batch_max_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._n_in_flight = 0
+        self.n_requests = 0
+        self.n_fields = 0
+
+    def submit(self, field):
+        """Đăng ký một field, trả về Future chứa kết quả của field đó"""
+        future = Future()
+        with self._lock:
+            self._pending.append((field, future))
+            if len(self._pending) >= self.max_batch_size or (
+                len(self._pending) == 1 and self._n_in_flight == 0
+            ):
+                batch = self._take_pending()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if batch:
+            self._send_batch(batch)
+        return future
+
+    def query(self, field):
+        return self.submit(field).result()
+
+    def _take_pending(self):
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            batch = self._take_pending()
+        if batch:
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        with self._lock:
+            self._n_in_flight += 1
+        try:
+            self._send_aliased(batch)
+        finally:
+            with self._lock:
+                self._n_in_flight -= 1
+
+    def _send_aliased(self, batch):
+        aliases = [f"q{i}" for i in range(len(batch))]
+        query = "query {\n"
+        for alias, (field, _) in zip(aliases, batch):
+            query += f"{alias}: {field.strip()}\n"
+        query += "}"
+
+        self.n_requests += 1
+        self.n_fields += len(batch)
+        try:
+            data = self.send(query)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        # lỗi GraphQL chỉ ảnh hưởng tới alias nằm trong path của lỗi
+        errors = {}
+        for error in data.get("errors") or []:
+            path = error.get("path") or []
+            if path:
+                errors.setdefault(path[0], error.get("message"))
+
+        results = data.get("data") or {}
+        for alias, (_, future) in zip(aliases, batch):
+            if results.get(alias) is None:
+                message = errors.get(alias) or data.get("errors") or "no data"
+                future.set_exception(ValueError(f"GraphQL error: {message}"))
+            else:
+                future.set_result(results[alias])
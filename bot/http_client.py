@@ -0,0 +1,81 @@
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+
+# (connect, read) timeout theo giây cho từng endpoint, có thể ghi đè trong config.yml
+DEFAULT_TIMEOUTS = {
+    "copin_graphql": (3.05, 20.0),
+    "bingx": (3.05, 10.0),
+    "bitget": (3.05, 10.0),
+    "default": (3.05, 15.0),
+}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _endpoint_timeout(endpoint):
+    timeouts = {**DEFAULT_TIMEOUTS, **config.http_timeouts}
+    timeout = timeouts.get(endpoint, timeouts["default"])
+    if isinstance(timeout, (int, float)):
+        return (timeout, timeout)
+    return tuple(timeout)
+
+
+def _backoff_delay(attempt):
+    """Full jitter: chờ ngẫu nhiên trong [0, base * 2^attempt], tối đa max_backoff"""
+    cap = min(config.http_max_backoff, config.http_backoff * 2**attempt)
+    return random.uniform(0, cap)
+
+
+class HttpError(Exception):
+    pass
+
+
+class HttpClient:
+    """Client HTTP đồng bộ dùng chung: giữ kết nối keep-alive, timeout và retry
+
+    Một instance dùng được từ nhiều thread; mỗi process nên tạo instance riêng.
+    """
+
+    def __init__(self, pool_size=None, max_retries=None):
+        self.pool_size = pool_size or config.http_pool_size
+        self.max_retries = (
+            config.http_max_retries if max_retries is None else max_retries
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size, pool_maxsize=self.pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, endpoint="default", **kwargs):
+        kwargs.setdefault("timeout", _endpoint_timeout(endpoint))
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise HttpError(f"{method} {url} failed: {e}") from e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response
+                if attempt == self.max_retries:
+                    raise HttpError(
+                        f"{method} {url} failed with status {response.status_code}"
+                    )
+            time.sleep(_backoff_delay(attempt))
+
+    def get(self, url, endpoint="default", **kwargs):
+        return self.request("GET", url, endpoint=endpoint, **kwargs)
+
+    def post(self, url, endpoint="default", **kwargs):
+        return self.request("POST", url, endpoint=endpoint, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -1,11 +1,19 @@
+import asyncio
 import base64
 from io import BytesIO
 import config
 import logging
 
-import tiktoken
+import aiohttp
 import openai
 from analyze_func import analyze_trader
+from token_counter import (
+    MIN_DIALOG_MESSAGE_TOKENS,
+    StreamTokenCounter,
+    count_message_tokens,
+    dialog_message_tokens,
+    get_encoding,
+)
 
 
 # setup openai
@@ -24,16 +32,66 @@ OPENAI_COMPLETION_OPTIONS = {
 }
 
 
+class OpenAIClient:
+    """aiohttp session shared by every OpenAI request of the process
+
+    Opened in post_init and closed on shutdown. openai 0.28 reads the session
+    from the `openai.aiosession` contextvar, so each API call must `bind()`
+    first in its own coroutine.
+    """
+
+    def __init__(self, pool_size=None):
+        self.pool_size = pool_size or config.openai_pool_size
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=config.http_keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    def bind(self):
+        if self.session is not None and not self.session.closed:
+            openai.aiosession.set(self.session)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+openai_client = OpenAIClient()
+# one ChatGPT per model, reused across requests
+chatgpt_instances = {}
+
+
+def get_chatgpt(model):
+    if model not in chatgpt_instances:
+        chatgpt_instances[model] = ChatGPT(model=model)
+    return chatgpt_instances[model]
+
+
 class ChatGPT:
     def __init__(self, model="gpt-4o-mini"):
         assert model in {"gpt-4o-mini", "gpt-4o", "gpt-4"}, f"Unknown model: {model}"
         self.model = model
+        request_timeout = config.models["info"][model].get(
+            "request_timeout", OPENAI_COMPLETION_OPTIONS["request_timeout"]
+        )
+        self.completion_options = {
+            **OPENAI_COMPLETION_OPTIONS,
+            "request_timeout": request_timeout,
+        }
 
     async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
+        dialog_messages = self._trim_dialog_messages(
+            message, dialog_messages, chat_mode
+        )
         answer = None
         while answer is None:
             try:
@@ -42,8 +100,9 @@ class ChatGPT:
                         message, dialog_messages, chat_mode
                     )
 
+                    openai_client.bind()
                     r = await openai.ChatCompletion.acreate(
-                        model=self.model, messages=messages, **OPENAI_COMPLETION_OPTIONS
+                        model=self.model, messages=messages, **self.completion_options
                     )
                     answer = r.choices[0].message["content"]
                 # elif self.model == "text-davinci-003":
@@ -62,7 +121,10 @@ class ChatGPT:
                     r.usage.prompt_tokens,
                     r.usage.completion_tokens,
                 )
-            except Exception as e:  # too many tokens
+            except openai.error.InvalidRequestError as e:
+                # our token estimate differs from the API's, still over the context
+                if e.code != "context_length_exceeded":
+                    raise
                 if len(dialog_messages) == 0:
                     raise ValueError(
                         "Dialog messages is reduced to zero, but still has too many tokens to make completion"
@@ -88,7 +150,8 @@ class ChatGPT:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
         elif chat_mode =="Copin Analysys":
             account = next(iter(dialog_messages), None)
-            stats = analyze_trader(account,"BINGX")
+            # the analysis makes blocking HTTP and pymongo calls, run it in a thread
+            stats = await asyncio.to_thread(analyze_trader, account, "BINGX")
             result= {}
             result['reverse_copy'] = stats[0]
             result['leverage'] = stats[1]
@@ -97,64 +160,64 @@ class ChatGPT:
             messages = self._generate_prompt_copin(
                         message, result, chat_mode
                     )
+            openai_client.bind()
             r_gen = await openai.ChatCompletion.acreate(
                         model=self.model,
                         messages=messages,
                         stream=True,
-                        **OPENAI_COMPLETION_OPTIONS,
+                        **self.completion_options,
                     )
 
             answer = ""
+            token_counter = StreamTokenCounter(messages, self.model)
+            n_first_dialog_messages_removed = 0
             async for r_item in r_gen:
                 delta = r_item.choices[0].delta
 
                 if "content" in delta:
                     answer += delta.content
-                    n_input_tokens, n_output_tokens = (
-                        self._count_tokens_from_messages(
-                            messages, answer, model=self.model
-                        )
-                    )
-                    n_first_dialog_messages_removed = 0
+                    n_input_tokens, n_output_tokens = token_counter.add(delta.content)
 
                     yield "not_finished", answer, (
                         n_input_tokens,
                         n_output_tokens,
                     ), n_first_dialog_messages_removed
+            n_input_tokens, n_output_tokens = token_counter.finish()
             
         else:
             n_dialog_messages_before = len(dialog_messages)
+            dialog_messages = self._trim_dialog_messages(
+                message, dialog_messages, chat_mode
+            )
             answer = None
-            try:
-                if self.model in {"gpt-4o-mini", "gpt-4o", "gpt-4"}:
-                    messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode
-                    )
-
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS,
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-
-                        if "content" in delta:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = (
-                                self._count_tokens_from_messages(
-                                    messages, answer, model=self.model
-                                )
-                            )
-                            n_first_dialog_messages_removed = 0
+            while answer is None:
+                try:
+                    if self.model in {"gpt-4o-mini", "gpt-4o", "gpt-4"}:
+                        messages = self._generate_prompt_messages(
+                            message, dialog_messages, chat_mode
+                        )
 
-                            yield "not_finished", answer, (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ), n_first_dialog_messages_removed
+                        openai_client.bind()
+                        r_gen = await openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            stream=True,
+                            **self.completion_options,
+                        )
+                    else:
+                        raise ValueError(f"Unknown model: {self.model}")
+                except openai.error.InvalidRequestError as e:
+                    # our token estimate differs from the API's, still over the context
+                    if e.code != "context_length_exceeded":
+                        raise
+                    if len(dialog_messages) == 0:
+                        raise ValueError(
+                            "Dialog messages is reduced to zero, but still has too many tokens to make completion"
+                        ) from e
+
+                    # forget first message in dialog_messages
+                    dialog_messages = dialog_messages[1:]
+                    continue
 
                 # elif self.model == "text-davinci-003":
                 #     prompt = self._generate_prompt(message, dialog_messages, chat_mode)
@@ -172,14 +235,27 @@ class ChatGPT:
                 #         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
                 #         yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
-                answer = self._postprocess_answer(answer)
+                answer = ""
+                token_counter = StreamTokenCounter(messages, self.model)
+                n_first_dialog_messages_removed = n_dialog_messages_before - len(
+                    dialog_messages
+                )
+                async for r_item in r_gen:
+                    delta = r_item.choices[0].delta
 
-            except Exception as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
+                    if "content" in delta:
+                        answer += delta.content
+                        n_input_tokens, n_output_tokens = token_counter.add(
+                            delta.content
+                        )
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+                        yield "not_finished", answer, (
+                            n_input_tokens,
+                            n_output_tokens,
+                        ), n_first_dialog_messages_removed
+                n_input_tokens, n_output_tokens = token_counter.finish()
+
+            answer = self._postprocess_answer(answer)
 
         yield "finished", answer, (
             n_input_tokens,
@@ -224,6 +300,45 @@ class ChatGPT:
 
         return prompt
 
+    def _context_budget(self):
+        """Max prompt tokens: the model context minus what is reserved for the answer"""
+        context_window = config.models["info"][self.model]["context_window"]
+        return context_window - self.completion_options["max_tokens"]
+
+    def max_dialog_messages(self):
+        """Most dialog messages that can fit the context, i.e. how many to read
+
+        Anything read beyond this would certainly be dropped by _trim_dialog_messages.
+        """
+        return max(1, self._context_budget() // MIN_DIALOG_MESSAGE_TOKENS)
+
+    def _trim_dialog_messages(self, message, dialog_messages, chat_mode):
+        """Drop the first dialog messages so the prompt fits the model context
+
+        Uses the token count stored with each dialog message, so the history is
+        not re-encoded and an oversized prompt costs no extra request.
+        """
+        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        n_tokens = count_message_tokens(
+            [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": message},
+            ],
+            self.model,
+        )
+        n_dialog_tokens = [
+            dialog_message_tokens(dialog_message, self.model)
+            for dialog_message in dialog_messages
+        ]
+        n_tokens += sum(n_dialog_tokens)
+
+        n_removed = 0
+        budget = self._context_budget()
+        while n_tokens > budget and n_removed < len(dialog_messages):
+            n_tokens -= n_dialog_tokens[n_removed]
+            n_removed += 1
+        return dialog_messages[n_removed:]
+
     def _generate_prompt_messages(
         self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None
     ):
@@ -264,31 +379,8 @@ class ChatGPT:
         return answer
 
     def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        encoding = tiktoken.encoding_for_model(model)
-
-        tokens_per_message = 3
-
-        # input
-        n_input_tokens = 0
-        for message in messages:
-            n_input_tokens += tokens_per_message
-            if isinstance(message["content"], list):
-                for sub_message in message["content"]:
-                    if "type" in sub_message:
-                        if sub_message["type"] == "text":
-                            n_input_tokens += len(encoding.encode(sub_message["text"]))
-                        elif sub_message["type"] == "image_url":
-                            pass
-            else:
-                if "type" in message:
-                    if message["type"] == "text":
-                        n_input_tokens += len(encoding.encode(message["text"]))
-                    elif message["type"] == "image_url":
-                        pass
-
-        n_input_tokens += 2
-
-        # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
+        # the encoding is cached in token_counter, not rebuilt on every call
+        n_input_tokens = count_message_tokens(messages, model)
+        n_output_tokens = 1 + len(get_encoding(model).encode(answer))
 
         return n_input_tokens, n_output_tokens
@@ -0,0 +1,157 @@
+import numpy as np
+
+from candle_store import STORE_COLUMNS
+
+
+TIMESTAMP, OPEN, CLOSE, HIGH, LOW = range(len(STORE_COLUMNS))
+
+
+def build_candle_buffer(price_cryptos):
+    """Nối nến của nhiều vị thế thành một mảng (5, N) kèm offsets của từng vị thế"""
+    lengths = [len(price_crypto) for price_crypto in price_cryptos]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    candles = np.empty((len(STORE_COLUMNS), offsets[-1]), dtype=np.float64)
+    for price_crypto, start, end in zip(price_cryptos, offsets[:-1], offsets[1:]):
+        for row, column in enumerate(STORE_COLUMNS):
+            candles[row, start:end] = price_crypto[column]
+    return candles, offsets
+
+
+def build_candle_seconds(price_cryptos, interval_seconds):
+    """Độ dài (giây) của từng nến, dùng cột bar_seconds nếu nến đã được làm mịn"""
+    parts = [np.zeros(0)]
+    for price_crypto, seconds in zip(price_cryptos, interval_seconds):
+        if "bar_seconds" in price_crypto:
+            parts.append(price_crypto["bar_seconds"].to_numpy(np.float64))
+        else:
+            parts.append(np.full(len(price_crypto), seconds, dtype=np.float64))
+    return np.concatenate(parts)
+
+
+def compute_positions_metrics(
+    candles,
+    offsets,
+    open_times,
+    close_times,
+    is_long,
+    is_win,
+    leverage,
+    interval_seconds,
+    candle_seconds=None,
+):
+    """Tính chỉ số cho cả lô vị thế trong một lượt vector hoá
+
+    `candles` là mảng (5, N) theo thứ tự STORE_COLUMNS, nến của vị thế i nằm
+    trong [offsets[i], offsets[i + 1]). Các tham số còn lại là mảng theo vị
+    thế. `candle_seconds` (độ dài từng nến, mảng N phần tử) chỉ cần khi một
+    vị thế có nến nhiều khung thời gian. Trả về dict các mảng float64, NaN ở
+    những chỗ bản pandas trả None.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    open_times = np.asarray(open_times, dtype=np.float64)
+    close_times = np.asarray(close_times, dtype=np.float64)
+    is_long = np.asarray(is_long, dtype=bool)
+    is_win = np.asarray(is_win, dtype=bool)
+    leverage = np.asarray(leverage, dtype=np.float64)
+    interval_seconds = np.asarray(interval_seconds, dtype=np.float64)
+
+    n_positions = len(offsets) - 1
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    non_empty = lengths > 0
+    n_candles = candles.shape[1]
+
+    metrics = {
+        name: np.full(n_positions, np.nan)
+        for name in (
+            "RoiFinal",
+            "MinRoi",
+            "MaxRoi",
+            "LossTime",
+            "ConsecutiveLossTime",
+            "LossHandling",
+            "TPEfficiency",
+            "TPLate",
+            "TimestampMax",
+        )
+    }
+    if n_candles == 0 or not non_empty.any():
+        return metrics
+
+    # thông số của vị thế lặp lại cho từng nến
+    segment_id = np.repeat(np.arange(n_positions), lengths)
+    if candle_seconds is None:
+        candle_seconds = interval_seconds[segment_id]
+    candle_ms = np.asarray(candle_seconds, dtype=np.float64) * 1000
+    buy_price = np.where(non_empty, candles[OPEN, np.minimum(starts, n_candles - 1)], 1)
+    scale = (leverage * 100 / buy_price)[segment_id]
+    sign = np.where(is_long, 1.0, -1.0)[segment_id]
+
+    roi_close = sign * (candles[CLOSE] * scale - leverage[segment_id] * 100)
+    roi_a = sign * (candles[HIGH] * scale - leverage[segment_id] * 100)
+    roi_b = sign * (candles[LOW] * scale - leverage[segment_id] * 100)
+    # với lệnh short, giá thấp nhất cho ROI cao nhất
+    roi_high = np.where(sign > 0, roi_a, roi_b)
+    roi_low = np.where(sign > 0, roi_b, roi_a)
+
+    # reduceat chỉ đúng với đoạn khác rỗng, đoạn rỗng được giữ NaN
+    idx = starts[non_empty]
+    last = offsets[1:][non_empty] - 1
+
+    min_roi = np.fmin.reduceat(roi_low, idx)
+    max_roi = np.fmax.reduceat(roi_high, idx)
+    roi_final = roi_close[last]
+
+    losing = roi_close < 0
+    n_losing = np.add.reduceat(losing, idx)
+    n_winning = np.add.reduceat(roi_close > 0, idx)
+    loss_ms = np.add.reduceat(np.where(losing, candle_ms, 0), idx)
+
+    # chuỗi nến lỗ dài nhất: tách run theo thay đổi trạng thái hoặc đầu vị thế
+    run_boundary = np.empty(n_candles, dtype=bool)
+    run_boundary[0] = True
+    run_boundary[1:] = losing[1:] != losing[:-1]
+    run_boundary[idx] = True
+    run_starts = np.flatnonzero(run_boundary)
+    run_ms = np.add.reduceat(candle_ms, run_starts)
+    loss_run_ms = np.where(losing[run_starts], run_ms, 0)
+    longest_loss_run_ms = np.maximum.reduceat(
+        loss_run_ms, np.searchsorted(run_starts, idx)
+    )
+
+    # nến đầu tiên chạm MaxRoi của mỗi vị thế
+    is_max = roi_high == max_roi.repeat(lengths[non_empty])
+    first_max = np.minimum.reduceat(
+        np.where(is_max, np.arange(n_candles), n_candles), idx
+    )
+    timestamp_max = candles[TIMESTAMP, np.minimum(first_max, n_candles - 1)]
+
+    duration_ms = (close_times - open_times)[non_empty]
+    exist_loss = n_losing > 0
+    win = is_win[non_empty]
+
+    loss_time = np.where(exist_loss, loss_ms / duration_ms * 100, np.nan)
+    consecutive_loss_time = np.where(
+        exist_loss, longest_loss_run_ms / duration_ms * 100, np.nan
+    )
+    loss_handling = np.where(exist_loss & win, min_roi, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tp_efficiency = np.where(win, roi_final / max_roi * 100, np.nan)
+    tp_late = np.where(
+        n_winning > 0, timestamp_max < close_times[non_empty], np.nan
+    )
+
+    metrics["RoiFinal"][non_empty] = roi_final
+    metrics["MinRoi"][non_empty] = min_roi
+    metrics["MaxRoi"][non_empty] = max_roi
+    metrics["LossTime"][non_empty] = loss_time
+    metrics["ConsecutiveLossTime"][non_empty] = consecutive_loss_time
+    metrics["LossHandling"][non_empty] = loss_handling
+    metrics["TPEfficiency"][non_empty] = tp_efficiency
+    metrics["TPLate"][non_empty] = tp_late
+    metrics["TimestampMax"][non_empty] = np.where(
+        first_max < n_candles, timestamp_max, np.nan
+    )
+    return metrics
@@ -0,0 +1,135 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import config
+
+
+MISSING = object()
+
+
+def normalize_query(query, variables=None):
+    """Khoá cache: query đã bỏ khoảng trắng thừa cộng với variables đã sắp xếp"""
+    key = re.sub(r"\s+", " ", query).strip()
+    if variables:
+        key += " " + repr(sorted(variables.items()))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def query_type(query):
+    """Tên field gốc của query, ví dụ searchTopOpeningPosition"""
+    match = re.search(r"(\w+)\s*\(", query)
+    return match.group(1) if match else "default"
+
+
+class MongoCacheTier:
+    """Tầng cache thứ hai trong Mongo để nhiều process bot dùng chung
+
+    Document hết hạn được Mongo tự xoá nhờ TTL index trên `expires_at`.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def get(self, key):
+        document = self.collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+        if document is None:
+            return MISSING, None
+        # pymongo trả về datetime UTC không kèm tzinfo
+        expires_at = document["expires_at"].replace(tzinfo=timezone.utc)
+        return document["value"], expires_at.timestamp()
+
+    def set(self, key, value, expires_at):
+        self.collection.replace_one(
+            {"_id": key},
+            {"value": value, "expires_at": datetime.utcfromtimestamp(expires_at)},
+            upsert=True,
+        )
+
+
+class QueryCache:
+    """Cache kết quả query trong process: TTL theo loại query và LRU theo số entry"""
+
+    def __init__(self, max_size=None, ttls=None, second_tier=None):
+        self.max_size = max_size or config.graphql_cache_max_size
+        self.ttls = {**config.graphql_cache_ttl, **(ttls or {})}
+        self.second_tier = second_tier
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_second_tier_hits = 0
+        self.n_misses = 0
+
+    def ttl(self, query):
+        return self.ttls.get(query_type(query), self.ttls.get("default", 60))
+
+    def get(self, query, variables=None):
+        key = normalize_query(query, variables)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.n_hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.second_tier is not None:
+            try:
+                value, expires_at = self.second_tier.get(key)
+            except Exception as e:
+                print("Cache Mongo bị lỗi:", e)
+                value = MISSING
+            if value is not MISSING:
+                self._store(key, value, expires_at)
+                with self._lock:
+                    self.n_second_tier_hits += 1
+                return value
+
+        with self._lock:
+            self.n_misses += 1
+        return MISSING
+
+    def set(self, query, value, variables=None):
+        key = normalize_query(query, variables)
+        expires_at = time.time() + self.ttl(query)
+        self._store(key, value, expires_at)
+        if self.second_tier is not None:
+            try:
+                self.second_tier.set(key, value, expires_at)
+            except Exception as e:
+                print("Cache Mongo bị lỗi:", e)
+
+    def _store(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, query, fetch, variables=None):
+        value = self.get(query, variables)
+        if value is MISSING:
+            value = fetch(query)
+            self.set(query, value, variables)
+        return value
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.n_hits,
+            "second_tier_hits": self.n_second_tier_hits,
+            "misses": self.n_misses,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
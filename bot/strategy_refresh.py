@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import time
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+class StrategyRefresher:
+    """Làm mới bảng xếp hạng của các strategy trong nền
+
+    Mỗi `interval` giây, từng strategy trong config.strategy được query lại từ
+    copin và ghi vào Mongo (chạy trong thread pool để không chặn event loop).
+    Top N trader sau đó được thay thế nguyên khối trong `leaderboards`, nên
+    handler Telegram luôn đọc được một snapshot đầy đủ mà không phải chờ.
+    """
+
+    def __init__(self, db, strategies=None, interval=None, top_n=None):
+        self.db = db
+        self.strategies = list(strategies or config.strategy)
+        self.interval = interval or config.strategy_refresh_interval
+        self.top_n = top_n or config.strategy_top_n
+        # strategy -> (thời điểm làm mới, tuple các document trader)
+        self.leaderboards = {}
+        self._task = None
+
+    async def get_leaderboard(self, strategy):
+        """Top N trader đã tính sẵn; lần đầu khi chưa có thì đọc snapshot trong Mongo"""
+        snapshot = self.leaderboards.get(strategy)
+        if snapshot is not None:
+            return snapshot[1]
+        leaderboard = await asyncio.get_running_loop().run_in_executor(
+            None, self.db.get_strategy, strategy, self.top_n
+        )
+        return tuple(leaderboard)
+
+    async def refresh(self, strategy):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.db.set_strategy, strategy)
+        leaderboard = await loop.run_in_executor(
+            None, self.db.get_strategy, strategy, self.top_n
+        )
+        self.leaderboards[strategy] = (time.time(), tuple(leaderboard))
+
+    async def refresh_all(self):
+        for strategy in self.strategies:
+            try:
+                await self.refresh(strategy)
+            except Exception:
+                logger.exception(f"Refresh strategy {strategy} failed")
+
+    async def run(self):
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import telegram
+
+import config
+
+
+class EditScheduler:
+    """Điều phối nhịp sửa tin nhắn khi stream câu trả lời, dùng chung cho cả bot
+
+    Mỗi chat sửa tin nhắn theo chu kỳ thời gian thay vì theo số ký tự. Chu kỳ
+    tăng khi nhiều chat cùng stream (chia giới hạn sửa toàn cục của Telegram)
+    và khi Telegram báo flood: RetryAfter hoặc lời gọi bị AIORateLimiter giữ
+    lại lâu. Chu kỳ giảm dần về mức cơ bản khi các lời gọi lại nhanh.
+    """
+
+    def __init__(
+        self,
+        interval=None,
+        group_interval=None,
+        max_interval=None,
+        global_edits_per_second=None,
+    ):
+        self.interval = interval or config.stream_edit_interval
+        self.group_interval = group_interval or config.stream_edit_group_interval
+        self.max_interval = max_interval or config.stream_edit_max_interval
+        self.global_edits_per_second = (
+            global_edits_per_second or config.stream_global_edits_per_second
+        )
+        self.n_active = 0
+        self.backoff = 1.0
+        self.paused_until = 0.0
+
+    def chat_interval(self, chat_id):
+        # chat_id âm là group, Telegram giới hạn chặt hơn chat riêng
+        base = self.group_interval if chat_id < 0 else self.interval
+        shared = self.n_active / self.global_edits_per_second
+        return min(self.max_interval, max(base, shared) * self.backoff)
+
+    def report_latency(self, latency, chat_id):
+        if latency > self.chat_interval(chat_id):
+            # lời gọi bị giữ lại lâu: AIORateLimiter đang chờ hoặc đã retry
+            self.backoff = min(self.backoff * 1.5, self.max_interval)
+        else:
+            self.backoff = max(1.0, self.backoff * 0.9)
+
+    def report_retry_after(self, retry_after):
+        self.backoff = min(self.backoff * 2, self.max_interval)
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    @asynccontextmanager
+    async def stream(self, bot, chat_id, message_id, parse_mode=None):
+        self.n_active += 1
+        try:
+            yield StreamEditor(self, bot, chat_id, message_id, parse_mode)
+        finally:
+            self.n_active -= 1
+
+
+class StreamEditor:
+    """Sửa một tin nhắn placeholder bằng nội dung mới nhất theo nhịp của scheduler"""
+
+    def __init__(self, scheduler, bot, chat_id, message_id, parse_mode=None):
+        self.scheduler = scheduler
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.parse_mode = parse_mode
+        self.sent_text = None
+        self.last_edit_time = None
+        self.n_edits = 0
+
+    def _is_due(self):
+        now = time.monotonic()
+        if now < self.scheduler.paused_until:
+            return False
+        if self.last_edit_time is None:
+            return True
+        return now - self.last_edit_time >= self.scheduler.chat_interval(self.chat_id)
+
+    async def update(self, text):
+        """Gửi text nếu đã tới lượt, ngược lại bỏ qua (lần sau gửi bản mới hơn)"""
+        if text == self.sent_text or not self._is_due():
+            return
+        try:
+            await self._edit(text)
+        except telegram.error.RetryAfter as e:
+            self.scheduler.report_retry_after(e.retry_after)
+
+    async def finish(self, text):
+        """Luôn gửi bản cuối, chờ hết thời gian flood nếu bị Telegram chặn"""
+        while text != self.sent_text:
+            delay = self.scheduler.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self._edit(text)
+            except telegram.error.RetryAfter as e:
+                self.scheduler.report_retry_after(e.retry_after)
+
+    async def _edit(self, text):
+        start = time.monotonic()
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                parse_mode=self.parse_mode,
+            )
+        except telegram.error.BadRequest as e:
+            if not str(e).startswith("Message is not modified"):
+                # answer has invalid characters, so we send it without parse_mode
+                await self.bot.edit_message_text(
+                    text, chat_id=self.chat_id, message_id=self.message_id
+                )
+        self.last_edit_time = time.monotonic()
+        self.sent_text = text
+        self.n_edits += 1
+        self.scheduler.report_latency(self.last_edit_time - start, self.chat_id)
@@ -0,0 +1,119 @@
+from functools import lru_cache
+
+import tiktoken
+
+
+# số token cố định của mỗi message và của phần mở đầu câu trả lời
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 2
+# cặp user/bot nhỏ nhất chiếm ít nhất chừng này token trong prompt
+MIN_DIALOG_MESSAGE_TOKENS = 2 * TOKENS_PER_MESSAGE
+
+# phần đuôi câu trả lời được encode lại mỗi delta; dài hơn thì chốt phần đầu
+MAX_TAIL_CHARS = 512
+# số token cuối giữ lại trong phần đuôi khi chốt, vì token ở biên có thể đổi
+# khi có thêm text
+KEEP_TAIL_TOKENS = 16
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Encoding của model, chỉ tạo một lần mỗi process"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_message_tokens(messages, model):
+    """Số token input của list message chat (ảnh không được tính)"""
+    encoding = get_encoding(model)
+    n_tokens = 0
+    for message in messages:
+        n_tokens += TOKENS_PER_MESSAGE
+        content = message["content"]
+        if isinstance(content, list):
+            for sub_message in content:
+                if sub_message.get("type") == "text":
+                    n_tokens += len(encoding.encode(sub_message["text"]))
+        else:
+            n_tokens += len(encoding.encode(content))
+    return n_tokens + TOKENS_PER_REPLY
+
+
+def count_dialog_message_tokens(dialog_message, model):
+    """Số token mà một cặp user/bot của dialog chiếm trong prompt"""
+    messages = [
+        {"role": "user", "content": dialog_message["user"]},
+        {"role": "assistant", "content": dialog_message["bot"]},
+    ]
+    return count_message_tokens(messages, model) - TOKENS_PER_REPLY
+
+
+def with_token_count(dialog_message, model):
+    """Gắn số token vào dialog message trước khi lưu để không phải đếm lại"""
+    return {
+        **dialog_message,
+        "n_tokens": count_dialog_message_tokens(dialog_message, model),
+        "token_encoding": get_encoding(model).name,
+    }
+
+
+def dialog_message_tokens(dialog_message, model):
+    """Số token đã lưu của dialog message, chỉ đếm lại khi khác encoding"""
+    if dialog_message.get("token_encoding") == get_encoding(model).name:
+        return dialog_message["n_tokens"]
+    return count_dialog_message_tokens(dialog_message, model)
+
+
+class StreamTokenCounter:
+    """Đếm token của câu trả lời stream mà không encode lại từ đầu mỗi delta
+
+    Chỉ phần đuôi (tối đa MAX_TAIL_CHARS) được encode lại; khi đuôi dài quá,
+    các token đầu được chốt vào bộ đếm. BPE không ghép token qua ranh giới
+    từ/khoảng trắng nên phần đã chốt không đổi khi có thêm text. `finish()`
+    encode lại toàn bộ một lần để có số chính xác.
+    """
+
+    def __init__(self, messages, model):
+        self.encoding = get_encoding(model)
+        self.n_input_tokens = count_message_tokens(messages, model)
+        self._chunks = []
+        self._n_committed_tokens = 0
+        self._tail = ""
+
+    def add(self, delta):
+        """Thêm một delta, trả về (n_input_tokens, n_output_tokens) hiện tại"""
+        self._chunks.append(delta)
+        self._tail += delta
+        tail_tokens = self.encoding.encode(self._tail)
+        n_tail_tokens = len(tail_tokens)
+        if len(self._tail) > MAX_TAIL_CHARS:
+            n_tail_tokens = self._commit(tail_tokens)
+        return self.n_input_tokens, 1 + self._n_committed_tokens + n_tail_tokens
+
+    def _commit(self, tail_tokens):
+        """Chốt các token đầu của phần đuôi, trả về số token còn lại trong đuôi"""
+        tail_bytes = self._tail.encode("utf-8")
+        n_keep = KEEP_TAIL_TOKENS
+        while n_keep < len(tail_tokens):
+            cut = len(self.encoding.decode_bytes(tail_tokens[:-n_keep]))
+            # chỉ cắt ở ranh giới ký tự UTF-8
+            if cut == len(tail_bytes) or tail_bytes[cut] & 0xC0 != 0x80:
+                self._n_committed_tokens += len(tail_tokens) - n_keep
+                self._tail = tail_bytes[cut:].decode("utf-8")
+                return n_keep
+            n_keep += 1
+        return len(tail_tokens)
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+    def finish(self):
+        """(n_input_tokens, n_output_tokens) chính xác của toàn bộ câu trả lời"""
+        text = self.text
+        self._chunks = [text]
+        self._tail = text
+        self._n_committed_tokens = 0
+        return self.n_input_tokens, 1 + len(self.encoding.encode(text))
@@ -0,0 +1,70 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+
+class UserCache:
+    """Cache document user trong process, entry bị bỏ khi không dùng quá idle_timeout
+
+    Cache chỉ đúng khi mọi thay đổi user đều đi qua Database của process này
+    (ghi xuống Mongo rồi cập nhật cache).
+    """
+
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = (
+            config.user_cache_idle_timeout if idle_timeout is None else idle_timeout
+        )
+        # user_id -> (lần dùng cuối, document), cũ nhất ở đầu
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _evict_idle(self, now):
+        while self._entries:
+            user_id, (last_used, _) = next(iter(self._entries.items()))
+            if now - last_used <= self.idle_timeout:
+                break
+            del self._entries[user_id]
+
+    def get(self, user_id):
+        """Document của user, None nếu chưa có trong cache"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.n_misses += 1
+                return None
+            self._entries[user_id] = (now, entry[1])
+            self._entries.move_to_end(user_id)
+            self.n_hits += 1
+            return entry[1]
+
+    def set(self, user_id, document):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[user_id] = (now, copy.deepcopy(document))
+            self._entries.move_to_end(user_id)
+            self._evict_idle(now)
+
+    def update(self, user_id, fields):
+        """Áp các field vừa $set xuống Mongo vào document đang cache (nếu có)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[1].update(copy.deepcopy(fields))
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.n_hits,
+            "misses": self.n_misses,
+        }